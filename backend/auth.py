@@ -1,13 +1,20 @@
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Query, WebSocket, WebSocketException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from database import SessionLocal
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal
 from models import User as DBUser
-from crud import get_user_by_username
+from crud import get_user_by_username, set_user_active
+from passwords import verify_password
+from schemas import CurrentUser
+from protocol import websocket_token
+from lru import TTLCache
+from redis_client import get_cached_principal, cache_principal, invalidate_principal
+import logging
 import os
+import time
 
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key")
 ALGORITHM = "HS256"
@@ -15,18 +22,23 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 720
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def get_db():
-    db = SessionLocal()
-    try:
+# Проверенные токены: token -> CurrentUser. Запись живет не дольше AUTH_CACHE_TTL и не дольше самого токена
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "60"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+# Общий для всех узлов кэш пользователей в Redis
+AUTH_CACHE_REDIS = os.getenv("AUTH_CACHE_REDIS", "1") == "1"
+
+_token_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-def authenticate_user(db: Session, username: str, password: str):
+async def authenticate_user(db: AsyncSession, username: str, password: str):
     import logging
     logging.info(f"Attempting to authenticate user: {username}")
 
-    user = get_user_by_username(db, username)
+    user = await get_user_by_username(db, username)
     if not user:
         logging.warning(f"User not found: {username}")
         return False
@@ -35,32 +47,15 @@ def authenticate_user(db: Session, username: str, password: str):
         logging.warning(f"User is not active: {username}")
         return False
 
-    if not verify_password(password, user.hashed_password):
+    # Пока bcrypt проверяет пароль, соединение не держим: close() отвязывает user, не сбрасывая загруженные поля
+    await db.close()
+    if not await verify_password(password, user.hashed_password):
         logging.warning(f"Password verification failed for user: {username}")
         return False
 
     logging.info(f"User authenticated successfully: {username}")
     return user
 
-def verify_password(plain_password, hashed_password):
-    from passlib.context import CryptContext
-    pwd_context = CryptContext(
-        schemes=["bcrypt"],
-        deprecated="auto",
-        bcrypt__rounds=12,
-        bcrypt__ident="2b"
-    )
-
-    try:
-        return pwd_context.verify(plain_password, hashed_password)
-    except Exception as e:
-        # Пробуем прямую проверку через bcrypt
-        try:
-            import bcrypt
-            return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
-        except:
-            return False
-
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -71,20 +66,73 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    principal = await authenticate_token(db, token)
+    if principal is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return principal
+
+async def get_websocket_user(websocket: WebSocket, token: Optional[str] = Query(None)):
+    # Браузерный WebSocket не передает заголовок Authorization: токен приходит в подпротоколе
+    # access_token.<jwt> (не попадает в логи с URL) или в параметре token для остальных клиентов.
+    # Сессия открывается только на время проверки, а не на все время жизни сокета
+    token = websocket_token(websocket.scope.get("subprotocols", [])) or token
+    principal = None
+    if token:
+        async with AsyncSessionLocal() as db:
+            principal = await authenticate_token(db, token)
+    if principal is None:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Could not validate credentials")
+    return principal
+
+async def authenticate_token(db: AsyncSession, token: str) -> Optional[CurrentUser]:
+    principal = _token_cache.get(token)
+    if principal is not None:
+        return principal
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
-    user = get_user_by_username(db, username=username)
+        return None
+    username: str = payload.get("sub")
+    if username is None:
+        return None
+    principal = await _load_principal(db, username)
+    if principal is None or not principal.is_active:
+        return None
+    _token_cache.set(token, principal, ttl=min(AUTH_CACHE_TTL, payload["exp"] - time.time()))
+    return principal
+
+async def _load_principal(db: AsyncSession, username: str) -> Optional[CurrentUser]:
+    if AUTH_CACHE_REDIS:
+        try:
+            cached = await get_cached_principal(username)
+            if cached is not None:
+                return CurrentUser(**cached)
+        except Exception as e:
+            logging.warning(f"Auth cache unavailable: {e}")
+
+    user = await get_user_by_username(db, username=username)
     if user is None:
-        raise credentials_exception
-    return user
\ No newline at end of file
+        return None
+    principal = CurrentUser.model_validate(user)
+    if AUTH_CACHE_REDIS:
+        try:
+            await cache_principal(username, principal.model_dump(), AUTH_CACHE_TTL)
+        except Exception as e:
+            logging.warning(f"Auth cache unavailable: {e}")
+    return principal
+
+def forget_user(username: str):
+    # Сбрасывает локальные записи пользователя; вызывается и по событию из Redis от других узлов
+    _token_cache.discard_where(lambda principal: principal.username == username)
+
+async def set_active(db: AsyncSession, user_id: int, is_active: bool):
+    username = await set_user_active(db, user_id, is_active)
+    if username is not None:
+        forget_user(username)
+        await invalidate_principal(username)
+    return username
\ No newline at end of file
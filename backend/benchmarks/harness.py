@@ -0,0 +1,364 @@
+# Нагрузочный прогон горячих путей REST и WebSocket без внешней инфраструктуры.
+# По умолчанию база - временный файл SQLite со схемой из миграций, Redis - fakeredis в памяти;
+# --database-url / --redis-url позволяют направить прогон на локальные Postgres и Redis.
+# Приложение вызывается in-process через ASGI (httpx.ASGITransport), WebSocket-клиенты подключаются
+# к ConnectionManager напрямую, поэтому измеряется код сервера, а не сеть.
+# Результат - JSON (пропускная способность, p50/p99, SQL-запросов на запрос), который удобно сравнивать
+# между версиями:
+#   python benchmarks/harness.py --users 200 --chats 50 --ws-clients 500 --output before.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+SCENARIOS = ["token", "send_message", "read_history", "read_history_page", "chat_list", "online_users", "search",
+             "broadcast"]
+BENCH_PASSWORD = "benchmark-password"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="REST and WebSocket benchmark harness")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--members-per-chat", type=int, default=10)
+    parser.add_argument("--messages-per-chat", type=int, default=200)
+    parser.add_argument("--ws-clients", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=500, help="requests per REST scenario")
+    parser.add_argument("--token-requests", type=int, default=50, help="logins for the bcrypt-bound /token scenario")
+    parser.add_argument("--broadcast-events", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--database-url", help="defaults to a temporary SQLite file")
+    parser.add_argument("--redis-url", help="defaults to in-memory fakeredis")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    return parser.parse_args()
+
+
+def configure_environment(args) -> Optional[str]:
+    # Окружение нужно задать до импорта модулей приложения: они читают его при импорте
+    temp_db = None
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        temp_db = os.path.join(tempfile.mkdtemp(prefix="messenger-bench-"), "bench.sqlite")
+        os.environ["DATABASE_URL"] = f"sqlite:///{temp_db}"
+    if args.redis_url:
+        os.environ["REDIS_URL"] = args.redis_url
+    if not os.getenv("ENCRYPTION_KEY"):
+        from cryptography.fernet import Fernet
+        os.environ["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+    os.environ["EXPOSE_QUERY_COUNT"] = "1"
+    # Лимиты частоты проверяются, но не должны срабатывать: измеряется пропускная способность, а не отказы
+    for name in ("RATE_LIMIT_MESSAGES_USER", "RATE_LIMIT_MESSAGES_CHAT", "RATE_LIMIT_WS_FRAMES_USER"):
+        os.environ.setdefault(name, "1000000/1")
+    return temp_db
+
+
+def use_fake_redis():
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("fakeredis is not installed: pip install fakeredis lupa, or pass --redis-url")
+    import redis_client
+    redis_client.redis_client = fakeredis.aioredis.FakeRedis()
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float], queries: List[int], errors: int, elapsed: float, units: int = None) -> dict:
+    latencies = sorted(latencies)
+    completed = len(latencies)
+    return {
+        "requests": completed + errors,
+        "errors": errors,
+        "duration_s": round(elapsed, 4),
+        "throughput_rps": round((units if units is not None else completed) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+        "queries_per_request": round(statistics.fmean(queries), 2) if queries else None,
+    }
+
+
+async def drive(count: int, concurrency: int, request: Callable[[int], Awaitable]) -> dict:
+    # Выполняет count запросов не более чем concurrency одновременно
+    latencies: List[float] = []
+    queries: List[int] = []
+    errors = 0
+    next_index = 0
+
+    async def worker():
+        nonlocal errors, next_index
+        while next_index < count:
+            index = next_index
+            next_index += 1
+            start = time.perf_counter()
+            try:
+                response = await request(index)
+            except Exception:
+                errors += 1
+                continue
+            if response.status_code >= 400:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            if "X-DB-Queries" in response.headers:
+                queries.append(int(response.headers["X-DB-Queries"]))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, count))))
+    return summarize(latencies, queries, errors, time.perf_counter() - started)
+
+
+async def seed(args) -> dict:
+    import random
+    from sqlalchemy import insert
+    from database import AsyncSessionLocal
+    from encryption import message_crypto
+    from models import User, Chat, Message, chat_members
+    from passwords import hash_password
+    from search_index import backfill
+
+    rng = random.Random(42)
+    # Один хэш на всех: сидирование не должно занимать минуты bcrypt
+    hashed_password = await hash_password(BENCH_PASSWORD)
+    usernames = [f"bench_user_{i}" for i in range(args.users)]
+    async with AsyncSessionLocal() as db:
+        await db.execute(insert(User), [{"username": name, "hashed_password": hashed_password, "is_active": True}
+                                        for name in usernames])
+        await db.execute(insert(Chat), [{"name": f"bench chat {i}", "is_group": True} for i in range(args.chats)])
+        await db.flush()
+        user_ids = list(range(1, args.users + 1))
+        memberships: Dict[int, List[int]] = {}
+        rows = []
+        for chat_id in range(1, args.chats + 1):
+            members = rng.sample(user_ids, min(args.members_per_chat, len(user_ids)))
+            memberships[chat_id] = members
+            rows.extend({"chat_id": chat_id, "user_id": user_id} for user_id in members)
+        await db.execute(insert(chat_members), rows)
+        for chat_id, members in memberships.items():
+            texts = [f"seed message {i} in chat {chat_id}" for i in range(args.messages_per_chat)]
+            ciphertexts = message_crypto.encrypt_many(texts)
+            await db.execute(insert(Message), [
+                {"chat_id": chat_id, "user_id": rng.choice(members), "content": ciphertext}
+                for ciphertext in ciphertexts
+            ])
+        await db.commit()
+        # Сообщения вставлены мимо message_writer, поэтому поисковый индекс строится как при миграции
+        await db.run_sync(backfill)
+    return {"usernames": usernames, "memberships": memberships}
+
+
+class BenchSocket:
+    # Минимальная замена starlette WebSocket для ConnectionManager: считает доставленные кадры
+    def __init__(self, on_frame: Callable[[str], None]):
+        self.scope = {"subprotocols": []}
+        self.on_frame = on_frame
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        self.on_frame(data)
+
+    async def send_bytes(self, data: bytes):
+        pass
+
+    async def close(self, code: int = 1000, reason: str = None):
+        pass
+
+
+async def run_broadcast(args, seeded: dict) -> dict:
+    # Задержка от публикации события в Redis до доставки во все локальные сокеты чата
+    from protocol import FRAME_MESSAGE
+    from encryption import encrypt_message
+    from redis_client import publish_chat_event
+    from websocket import manager
+
+    memberships = seeded["memberships"]
+    chat_ids = list(memberships)
+    # (chat_id, seq) -> сколько сокетов еще не получили событие
+    pending: Dict[Tuple[int, int], int] = {}
+    done: Dict[Tuple[int, int], asyncio.Event] = {}
+
+    def on_frame(data: str):
+        frame = json.loads(data)
+        key = (frame.get("chat_id"), frame.get("seq"))
+        if frame.get("type") != FRAME_MESSAGE or key not in pending:
+            return
+        pending[key] -= 1
+        if pending[key] == 0:
+            done[key].set()
+
+    connections = []
+    for i in range(args.ws_clients):
+        chat_id = chat_ids[i % len(chat_ids)]
+        members = memberships[chat_id]
+        user_id = members[i // len(chat_ids) % len(members)]
+        connection = await manager.connect(BenchSocket(on_frame), user_id, chat_id, seeded["usernames"][user_id - 1])
+        connections.append(connection)
+
+    template = {"id": 0, "content": "", "timestamp": "2024-01-01T00:00:00", "user_id": 1, "chat_id": 0,
+                "user": {"id": 1, "username": "bench"}}
+    latencies = []
+    delivered = 0
+    errors = 0
+    started = time.perf_counter()
+    for i in range(args.broadcast_events):
+        chat_id = chat_ids[i % len(chat_ids)]
+        fanout = len(manager.chat_connections.get(chat_id, ()))
+        # События чата несут шифротекст, как и при обычной отправке
+        message = {**template, "id": 10_000_000 + i, "chat_id": chat_id, "content": encrypt_message(f"broadcast {i}")}
+        start = time.perf_counter()
+        seq = await publish_chat_event(chat_id, json.dumps(message))
+        if fanout == 0:
+            continue
+        # Подписчик получит событие не раньше следующего await, поэтому ожидание ставим сразу после публикации
+        key = (chat_id, seq)
+        pending[key] = fanout
+        done[key] = asyncio.Event()
+        try:
+            await asyncio.wait_for(done[key].wait(), timeout=5)
+        except asyncio.TimeoutError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+        delivered += fanout
+    elapsed = time.perf_counter() - started
+    for connection in connections:
+        manager.disconnect(connection)
+
+    result = summarize(latencies, [], errors, elapsed, units=delivered)
+    result["frames_delivered"] = delivered
+    result["throughput_unit"] = "frames/s"
+    return result
+
+
+async def run(args) -> dict:
+    import httpx
+    import main
+    from auth import create_access_token
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = {}
+    async with main.app.router.lifespan_context(main.app):
+        seeded = await seed(args)
+        usernames = seeded["usernames"]
+        memberships = seeded["memberships"]
+        chat_ids = list(memberships)
+        headers = {name: {"Authorization": f"Bearer {create_access_token(data={'sub': name})}"} for name in usernames}
+
+        def member_of(index: int):
+            chat_id = chat_ids[index % len(chat_ids)]
+            members = memberships[chat_id]
+            return chat_id, usernames[members[index % len(members)] - 1]
+
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def token(i):
+                return await client.post("/token", data={"username": usernames[i % len(usernames)],
+                                                         "password": BENCH_PASSWORD})
+
+            async def send_message(i):
+                chat_id, username = member_of(i)
+                return await client.post("/messages/", json={"content": f"bench {i}", "chat_id": chat_id},
+                                         headers=headers[username])
+
+            async def read_history(i):
+                chat_id, username = member_of(i)
+                return await client.get(f"/messages/{chat_id}", headers=headers[username])
+
+            async def read_history_page(i):
+                # Листание назад мимо кэша последних сообщений
+                chat_id, username = member_of(i)
+                return await client.get(f"/messages/{chat_id}", params={"before_id": 10 + i % 50, "limit": 60},
+                                        headers=headers[username])
+
+            async def chat_list(i):
+                return await client.get("/chats/", headers=headers[usernames[i % len(usernames)]])
+
+            async def online_users(i):
+                return await client.get("/online-users/")
+
+            async def search(i):
+                chat_id, username = member_of(i)
+                return await client.get(f"/chats/{chat_id}/search",
+                                        params={"q": f"message {i % args.messages_per_chat}", "limit": 20},
+                                        headers=headers[username])
+
+            rest = {
+                "token": (token, args.token_requests),
+                "send_message": (send_message, args.requests),
+                "read_history": (read_history, args.requests),
+                "read_history_page": (read_history_page, args.requests),
+                "chat_list": (chat_list, args.requests),
+                "online_users": (online_users, args.requests),
+                "search": (search, args.requests),
+            }
+            for name in scenarios:
+                if name == "broadcast":
+                    results[name] = await run_broadcast(args, seeded)
+                else:
+                    request, count = rest[name]
+                    results[name] = await drive(count, args.concurrency, request)
+                print(f"{name:<20} {json.dumps(results[name])}", file=sys.stderr)
+    return results
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    args = parse_args()
+    temp_db = configure_environment(args)
+    if not args.redis_url:
+        use_fake_redis()
+    import logging
+    logging.disable(logging.WARNING)
+    import migrate
+    migrate.main()
+
+    results = asyncio.run(run(args))
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "database": "sqlite (temporary)" if temp_db else "external",
+        "redis": "fakeredis" if not args.redis_url else "external",
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "scenarios": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
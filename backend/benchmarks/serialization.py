@@ -0,0 +1,113 @@
+# Стоимость сериализации ответов по эндпоинтам. Сравниваются три способа получить тело ответа:
+#   legacy    - без response_model: jsonable_encoder + json.dumps (JSONResponse)
+#   orjson    - response_model + ORJSONResponse: валидация модели, dump в dict, orjson.dumps
+#   dump_json - response_model + класс ответа по умолчанию: валидация и dump_json в pydantic-core
+# Запуск из каталога backend: python benchmarks/serialization.py --chats 200 --members 50
+import argparse
+import json
+import os
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Модели тянут за собой database.py; для бенчмарка достаточно пустой SQLite
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.gettempdir(), 'serialization_bench.db')}")
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+import schemas
+from models import Chat, User
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def make_chats(count: int, members: int) -> List[Chat]:
+    users = [User(id=i, username=f"user{i}", hashed_password="x", is_active=True) for i in range(members)]
+    created = datetime(2024, 1, 1)
+    chats = []
+    for i in range(count):
+        chat = Chat(id=i, name=f"chat {i}", is_group=True, created_at=created + timedelta(minutes=i))
+        chat.members = users
+        chats.append(chat)
+    return chats
+
+
+def chats_as_dicts(chats: List[Chat]) -> List[dict]:
+    # ORM-объекты без response_model jsonable_encoder не сериализует: эндпоинт без схемы
+    # собирал бы такие словари сам
+    return [
+        {"id": chat.id, "name": chat.name, "is_group": chat.is_group, "created_at": chat.created_at,
+         "members": [{"id": user.id, "username": user.username} for user in chat.members]}
+        for chat in chats
+    ]
+
+
+def make_message_page(count: int) -> dict:
+    sent = datetime(2024, 1, 1)
+    messages = [
+        {
+            "id": i, "content": f"message number {i} " * 4, "timestamp": (sent + timedelta(seconds=i)).isoformat(),
+            "user_id": i % 10, "chat_id": 1, "user": {"id": i % 10, "username": f"user{i % 10}"}
+        }
+        for i in range(count)
+    ]
+    return {"messages": messages, "next_cursor": messages[0]["id"]}
+
+
+def legacy(payload, adapter: TypeAdapter) -> bytes:
+    return json.dumps(jsonable_encoder(payload), ensure_ascii=False).encode()
+
+
+def with_orjson(payload, adapter: TypeAdapter) -> bytes:
+    return orjson.dumps(adapter.dump_python(adapter.validate_python(payload, from_attributes=True), mode="json"))
+
+
+def with_dump_json(payload, adapter: TypeAdapter) -> bytes:
+    return adapter.dump_json(adapter.validate_python(payload, from_attributes=True))
+
+
+def measure(func, payload, adapter: TypeAdapter, repeat: int) -> float:
+    # Лучшее время одного вызова в миллисекундах
+    timer = timeit.Timer(lambda: func(payload, adapter))
+    return min(timer.repeat(repeat=repeat, number=1)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serialization cost per endpoint")
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    chats = make_chats(args.chats, args.members)
+    page = make_message_page(args.messages)
+    # endpoint, результат эндпоинта со схемой, результат без схемы, схема ответа
+    cases = [
+        ("GET /chats/", chats, chats_as_dicts(chats), TypeAdapter(List[schemas.Chat])),
+        ("GET /messages/{chat_id}", page, page, TypeAdapter(schemas.MessagePage)),
+        ("POST /messages/", page["messages"][0], page["messages"][0], TypeAdapter(schemas.Message)),
+    ]
+    variants = [("legacy", legacy), ("dump_json", with_dump_json)]
+    if orjson is not None:
+        variants.insert(1, ("orjson", with_orjson))
+
+    print(f"{'endpoint':<26}" + "".join(f"{name + ', ms':>14}" for name, _ in variants) + f"{'bytes':>10}")
+    for endpoint, payload, legacy_payload, adapter in cases:
+        timings = [
+            measure(func, legacy_payload if func is legacy else payload, adapter, args.repeat)
+            for _, func in variants
+        ]
+        size = len(with_dump_json(payload, adapter))
+        print(f"{endpoint:<26}" + "".join(f"{t:>14.3f}" for t in timings) + f"{size:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,35 @@
-from sqlalchemy.orm import Session
-from models import User, Chat, Message
+from sqlalchemy import select, insert, update, exists, func, case, and_, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from models import User, Chat, Message, chat_members, message_search_tokens
 from schemas import UserCreate, ChatCreate, MessageCreate
-from passlib.context import CryptContext
-from encryption import encrypt_message
-import logging
-
-# Настраиваем контекст паролей с явными параметрами
-pwd_context = CryptContext(
-    schemes=["bcrypt"],
-    deprecated="auto",
-    bcrypt__rounds=12,
-    bcrypt__ident="2b"
+from passwords import hash_password
+from encryption import message_crypto
+from message_writer import message_writer
+from message_archive import message_archive
+from membership import get_user_chat_ids, members_added
+from search_index import query_hashes
+from redis_client import (
+    record_message, get_cached_messages, begin_message_cache_warmup, warm_message_cache, invalidate_message_cache,
+    get_chat_summaries, warm_chat_summaries, set_unread_count, RECENT_MESSAGES_LIMIT
 )
+from typing import Dict, List, Optional
+import logging
 
 logger = logging.getLogger(__name__)
 
-def get_user_by_username(db: Session, username: str):
-    return db.query(User).filter(User.username == username).first()
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(User).where(User.username == username))
+    return result.scalars().first()
 
-def create_user(db: Session, user: UserCreate):
+async def create_user(db: AsyncSession, user: UserCreate):
     logger.info(f"Attempting to create user: {user.username}")
     logger.info(f"Password length: {len(user.password)} chars, {len(user.password.encode('utf-8'))} bytes")
 
     # Проверяем существование пользователя
-    existing_user = get_user_by_username(db, user.username)
+    existing_user = await get_user_by_username(db, user.username)
     if existing_user:
         logger.warning(f"User already exists: {user.username}")
         raise ValueError("User already exists")
@@ -41,67 +47,304 @@ def create_user(db: Session, user: UserCreate):
         logger.warning(f"Password truncated to 72 bytes")
 
     logger.info("Hashing password...")
-    try:
-        hashed_password = pwd_context.hash(password_to_hash)
-        logger.info("Password hashed successfully")
-    except Exception as e:
-        logger.error(f"Error hashing password: {e}")
-        # Пробуем альтернативный подход
-        try:
-            import bcrypt
-            salt = bcrypt.gensalt()
-            hashed_password = bcrypt.hashpw(password_to_hash.encode('utf-8'), salt).decode('utf-8')
-            logger.info("Password hashed using direct bcrypt")
-        except Exception as e2:
-            logger.error(f"Alternative hashing also failed: {e2}")
-            raise ValueError(f"Cannot hash password: {str(e)}")
+    # bcrypt занимает сотни миллисекунд, поэтому считаем его в отдельном ограниченном пуле.
+    # Соединение на это время возвращаем в пул, а уникальность имени окончательно проверит вставка
+    await db.close()
+    hashed_password = await hash_password(password_to_hash)
 
     logger.info("Creating user in database...")
     db_user = User(username=user.username, hashed_password=hashed_password)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        logger.warning(f"User already exists: {user.username}")
+        raise ValueError("User already exists")
     logger.info(f"User created successfully with id: {db_user.id}")
     return db_user
 
-def create_chat(db: Session, chat: ChatCreate, creator_id: int):
+async def set_user_active(db: AsyncSession, user_id: int, is_active: bool):
+    result = await db.execute(
+        update(User).where(User.id == user_id).values(is_active=is_active).returning(User.username)
+    )
+    username = result.scalar_one_or_none()
+    await db.commit()
+    return username
+
+async def create_chat(db: AsyncSession, chat: ChatCreate, creator_id: int):
+    # Всех участников загружаем одним запросом и вставляем связи одним executemany
+    member_ids = {creator_id, *chat.members}
+    result = await db.execute(select(User).where(User.id.in_(member_ids)))
+    members = result.scalars().all()
+
     db_chat = Chat(name=chat.name, is_group=chat.is_group)
     db.add(db_chat)
-    db.flush()
+    await db.flush()
+    if members:
+        await db.execute(insert(chat_members), [{"chat_id": db_chat.id, "user_id": m.id} for m in members])
+    await db.commit()
+    set_committed_value(db_chat, "members", list(members))
+    await members_added(db_chat.id, [m.id for m in members], new_chat=True)
+    return db_chat
 
-    creator = db.query(User).filter(User.id == creator_id).first()
-    db_chat.members.append(creator)
+async def add_user_to_chat(db: AsyncSession, chat_id: int, user_id: int) -> bool:
+    # Одна вставка вместо загрузки чата со всеми участниками; пропускает несуществующие чат/пользователя и повторы.
+    # Новый участник начинает с прочитанной историей
+    already_member = exists().where(chat_members.c.chat_id == chat_id, chat_members.c.user_id == user_id)
+    last_message_id = select(func.max(Message.id)).where(Message.chat_id == chat_id).scalar_subquery()
+    result = await db.execute(
+        insert(chat_members).from_select(
+            ["chat_id", "user_id", "last_read_message_id"],
+            select(Chat.id, User.id, last_message_id)
+            .join(User, User.id == user_id)
+            .where(Chat.id == chat_id, ~already_member)
+        )
+    )
+    await db.commit()
+    if result.rowcount == 0:
+        return False
+    await members_added(chat_id, [user_id])
+    return True
 
-    for uid in chat.members:
-        user = db.query(User).filter(User.id == uid).first()
-        if user:
-            db_chat.members.append(user)
+async def get_chat_name_and_member_ids(db: AsyncSession, chat_id: int):
+    result = await db.execute(
+        select(Chat.name, chat_members.c.user_id)
+        .join(chat_members, chat_members.c.chat_id == Chat.id)
+        .where(Chat.id == chat_id)
+    )
+    rows = result.all()
+    if not rows:
+        return None, []
+    return rows[0].name, [row.user_id for row in rows]
 
-    db.commit()
-    db.refresh(db_chat)
-    return db_chat
+async def get_user_chats(db: AsyncSession, user_id: int):
+    # Чаты с последним сообщением и числом непрочитанных, самые активные первыми.
+    # Сводка берется из Redis одним пайплайном; в базу идем только за тем, чего в Redis нет.
+    # Список чатов пользователя - из кэша членства, без чатов запрос в базу не нужен
+    chat_ids = await get_user_chat_ids(db, user_id)
+    if not chat_ids:
+        return []
+    result = await db.execute(
+        select(Chat, chat_members.c.last_read_message_id)
+        .join(chat_members, and_(chat_members.c.chat_id == Chat.id, chat_members.c.user_id == user_id))
+        .options(selectinload(Chat.members))
+    )
+    rows = result.all()
+    if not rows:
+        return []
+    chat_ids = [chat.id for chat, _ in rows]
+
+    try:
+        last_messages, unread = await get_chat_summaries(user_id, chat_ids)
+    except Exception as e:
+        logger.warning(f"Failed to read chat summaries from Redis: {e}")
+        last_messages, unread = {}, None
+    missing = [chat_id for chat_id in chat_ids if chat_id not in last_messages]
+    loaded = await _query_last_messages(db, missing) if missing else {}
+    last_messages.update(loaded)
+    rebuilt_unread = None
+    if unread is None:
+        unread = rebuilt_unread = await _query_unread_counts(db, user_id)
+    if loaded or rebuilt_unread is not None:
+        try:
+            await warm_chat_summaries(loaded, user_id, rebuilt_unread)
+        except Exception as e:
+            logger.warning(f"Failed to cache chat summaries: {e}")
+
+    previews = await message_crypto.decrypt_messages([m for m in last_messages.values() if m is not None])
+    previews = {message["chat_id"]: message for message in previews}
+    chats = [
+        {
+            "id": chat.id, "name": chat.name, "is_group": chat.is_group, "created_at": chat.created_at,
+            "members": chat.members, "last_message": previews.get(chat.id),
+            "last_read_message_id": last_read_message_id, "unread_count": unread.get(chat.id, 0),
+        }
+        for chat, last_read_message_id in rows
+    ]
+    chats.sort(key=_last_activity, reverse=True)
+    return chats
+
+def _last_activity(chat: dict) -> str:
+    if chat["last_message"] is not None:
+        return chat["last_message"]["timestamp"]
+    return chat["created_at"].isoformat() if chat["created_at"] else ""
+
+async def _query_last_messages(db: AsyncSession, chat_ids: List[int]) -> Dict[int, Optional[dict]]:
+    latest_ids = select(func.max(Message.id)).where(Message.chat_id.in_(chat_ids)).group_by(Message.chat_id)
+    result = await db.execute(select(Message).options(joinedload(Message.user)).where(Message.id.in_(latest_ids)))
+    messages = {msg.chat_id: serialize_message(msg, msg.user.username) for msg in result.scalars()}
+    # Чаты без сообщений в горячем окне: последнее сообщение может лежать в архиве
+    for chat_id in chat_ids:
+        if chat_id not in messages:
+            archived = await _merge_archived(db, chat_id, [], limit=1)
+            if archived:
+                messages[chat_id] = archived[-1]
+    return {chat_id: messages.get(chat_id) for chat_id in chat_ids}
+
+async def _query_unread_counts(db: AsyncSession, user_id: int) -> Dict[int, int]:
+    # Непрочитанные во всех чатах пользователя одним запросом; свои сообщения не считаются
+    result = await db.execute(
+        select(chat_members.c.chat_id, func.count(Message.id))
+        .select_from(chat_members)
+        .outerjoin(Message, and_(
+            Message.chat_id == chat_members.c.chat_id,
+            Message.id > func.coalesce(chat_members.c.last_read_message_id, 0),
+            Message.user_id != user_id
+        ))
+        .where(chat_members.c.user_id == user_id)
+        .group_by(chat_members.c.chat_id)
+    )
+    return {chat_id: count for chat_id, count in result.all()}
+
+async def mark_chat_read(db: AsyncSession, chat_id: int, user_id: int, message_id: Optional[int] = None):
+    # Позиция прочтения только растет; None, если пользователь не участник чата
+    latest_id = (await db.execute(select(func.max(Message.id)).where(Message.chat_id == chat_id))).scalar()
+    target = latest_id if message_id is None else min(message_id, latest_id or 0)
+    current = chat_members.c.last_read_message_id
+    result = await db.execute(
+        update(chat_members)
+        .where(chat_members.c.chat_id == chat_id, chat_members.c.user_id == user_id)
+        .values(last_read_message_id=case((func.coalesce(current, 0) < (target or 0), target), else_=current))
+        .returning(current)
+    )
+    row = result.first()
+    if row is None:
+        await db.rollback()
+        return None
+    last_read_message_id = row[0]
+    unread_count = 0
+    if latest_id is not None and (last_read_message_id or 0) < latest_id:
+        unread_count = (await db.execute(
+            select(func.count(Message.id))
+            .where(Message.chat_id == chat_id, Message.id > (last_read_message_id or 0), Message.user_id != user_id)
+        )).scalar()
+    await db.commit()
+    try:
+        await set_unread_count(user_id, chat_id, unread_count)
+    except Exception as e:
+        logger.warning(f"Failed to update unread count for user {user_id}: {e}")
+    return {"chat_id": chat_id, "last_read_message_id": last_read_message_id, "unread_count": unread_count}
+
+def serialize_message(message: Message, username: str) -> dict:
+    # Одинаковое представление сообщения для кэша Redis, рассылки по WebSocket и ответов REST
+    return {
+        "id": message.id,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+        "user_id": message.user_id,
+        "chat_id": message.chat_id,
+        "user": {"id": message.user_id, "username": username},
+    }
+
+async def create_message(message: MessageCreate, author: User, member_ids: List[int]):
+    # Запись идет через общую очередь group commit; функция возвращается после коммита пачки
+    db_message = await message_writer.submit(message.chat_id, author.id, message.content)
+    message_crypto.remember(db_message.id, message.content)
+
+    message_data = serialize_message(db_message, author.username)
+    try:
+        recipient_ids = [member_id for member_id in member_ids if member_id != author.id]
+        await record_message(message.chat_id, message_data, recipient_ids)
+    except Exception as e:
+        # Кэш без этого сообщения был бы неполным, поэтому сбрасываем его
+        logger.warning(f"Failed to cache message {db_message.id}: {e}")
+        await invalidate_message_cache(message.chat_id)
+    return message_data
+
+async def get_messages(db: AsyncSession, chat_id: int, before_id: Optional[int] = None,
+                       after_id: Optional[int] = None, limit: int = 60):
+    if before_id is None and after_id is None and limit <= RECENT_MESSAGES_LIMIT:
+        # Первая страница (самый частый запрос) читается из Redis, при промахе кэш прогревается
+        messages = await get_cached_messages(chat_id, limit)
+        if messages is None:
+            token = await begin_message_cache_warmup(chat_id)
+            messages = await _query_messages(db, chat_id, limit=RECENT_MESSAGES_LIMIT)
+            await warm_message_cache(chat_id, token, messages)
+            messages = messages[-limit:]
+    else:
+        messages = await _query_messages(db, chat_id, before_id, after_id, limit)
+    return await message_crypto.decrypt_messages(messages)
+
+async def _query_messages(db: AsyncSession, chat_id: int, before_id: Optional[int] = None,
+                          after_id: Optional[int] = None, limit: int = 60):
+    # Страница всегда читается по индексу (chat_id, id), без OFFSET
+    query = select(Message).options(joinedload(Message.user)).where(Message.chat_id == chat_id)
+    if after_id is not None:
+        query = query.where(Message.id > after_id).order_by(Message.id.asc())
+    else:
+        if before_id is not None:
+            query = query.where(Message.id < before_id)
+        query = query.order_by(Message.id.desc())
+    result = await db.execute(query.limit(limit))
+    messages = list(result.scalars().all())
+    # Возвращаем сообщения в хронологическом порядке
+    if after_id is None:
+        messages.reverse()
+    messages = [serialize_message(msg, msg.user.username) for msg in messages]
+    return await _merge_archived(db, chat_id, messages, before_id, after_id, limit)
+
+async def _merge_archived(db: AsyncSession, chat_id: int, messages: List[dict], before_id: Optional[int] = None,
+                          after_id: Optional[int] = None, limit: int = 60) -> List[dict]:
+    # Дополняет страницу из базы сообщениями из архивных сегментов, если курсор ушел за горячее окно
+    archived = await message_archive.read(db, chat_id, messages, before_id, after_id, limit)
+    if not archived:
+        return messages
+    merged = {msg["id"]: msg for msg in messages}
+    for msg in await _serialize_archived(db, archived):
+        merged.setdefault(msg["id"], msg)
+    ordered = [merged[message_id] for message_id in sorted(merged)]
+    return ordered[:limit] if after_id is not None else ordered[-limit:]
+
+async def _serialize_archived(db: AsyncSession, archived: list) -> List[dict]:
+    result = await db.execute(select(User.id, User.username).where(User.id.in_({msg.user_id for msg in archived})))
+    usernames = dict(result.all())
+    return [serialize_message(msg, usernames.get(msg.user_id)) for msg in archived]
+
+async def search_messages(db: AsyncSession, chat_id: int, query: str, cursor: Optional[str] = None, limit: int = 20):
+    # Поиск по слепому индексу: сначала сообщения, где совпало больше слов запроса, затем с большим
+    # числом вхождений, затем более новые. Расшифровывается только возвращаемая страница.
+    # Курсор - позиция последнего результата "совпадений.вес.id"
+    hashes = query_hashes(chat_id, query)
+    if not hashes:
+        return [], None
+    tokens = message_search_tokens
+    matched = func.count()
+    score = func.sum(tokens.c.weight)
+    statement = (
+        select(tokens.c.message_id, matched.label("matched"), score.label("score"))
+        .where(tokens.c.chat_id == chat_id, tokens.c.token_hash.in_(hashes))
+        .group_by(tokens.c.message_id)
+    )
+    if cursor is not None:
+        try:
+            position = tuple(int(part) for part in cursor.split("."))
+        except ValueError:
+            position = ()
+        if len(position) != 3:
+            raise ValueError("Invalid cursor")
+        statement = statement.having(tuple_(matched, score, tokens.c.message_id) < tuple_(*position))
+    result = await db.execute(
+        statement.order_by(matched.desc(), score.desc(), tokens.c.message_id.desc()).limit(limit)
+    )
+    hits = result.all()
+    if not hits:
+        return [], None
+
+    ids = [hit.message_id for hit in hits]
+    result = await db.execute(
+        select(Message).options(joinedload(Message.user)).where(Message.id.in_(ids), Message.chat_id == chat_id)
+    )
+    found = {msg.id: serialize_message(msg, msg.user.username) for msg in result.scalars()}
+    missing = [message_id for message_id in ids if message_id not in found]
+    if missing:
+        archived = await message_archive.get(db, chat_id, missing)
+        if archived:
+            found.update((msg["id"], msg) for msg in await _serialize_archived(db, archived))
+    messages = await message_crypto.decrypt_messages([found[message_id] for message_id in ids if message_id in found])
 
-def add_user_to_chat(db: Session, chat_id: int, user_id: int):
-    chat = db.query(Chat).filter(Chat.id == chat_id).first()
-    user = db.query(User).filter(User.id == user_id).first()
-    if chat and user:
-        chat.members.append(user)
-        db.commit()
-
-def get_user_chats(db: Session, user_id: int):
-    return db.query(Chat).filter(Chat.members.any(id=user_id)).all()
-
-def create_message(db: Session, message: MessageCreate, user_id: int):
-    encrypted_content = encrypt_message(message.content)
-    db_message = Message(content=encrypted_content, user_id=user_id, chat_id=message.chat_id)
-    db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
-    return db_message
-
-def get_messages(db: Session, chat_id: int, skip: int = 0, limit: int = 60):
-    messages = db.query(Message).filter(Message.chat_id == chat_id).offset(skip).limit(limit).all()
-    from encryption import decrypt_message
-    for msg in messages:
-        msg.content = decrypt_message(msg.content)
-    return messages
\ No newline at end of file
+    next_cursor = None
+    if len(hits) == limit:
+        last = hits[-1]
+        next_cursor = f"{last.matched}.{last.score}.{last.message_id}"
+    return messages, next_cursor
\ No newline at end of file
@@ -1,8 +1,11 @@
 import os
-from sqlalchemy import create_engine, text
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-import time
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from metrics import instrument_engine, timed_pool
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -10,36 +13,61 @@ logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://user:password@db:5432/messenger")
 
-# Создаем engine с настройками пула и retry
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,  # Проверяет соединение перед использованием
-    pool_size=10,
-    max_overflow=20,
-    pool_recycle=3600,  # Переподключаемся каждый час
+# Асинхронные драйверы для тех же баз, что и синхронный DATABASE_URL
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+def to_async_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}{sep}{rest}"
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", to_async_url(DATABASE_URL))
+
+# Пул на процесс. Под gunicorn воркеров несколько (WEB_CONCURRENCY), поэтому общий бюджет соединений
+# экземпляра DB_MAX_CONNECTIONS делится между ними: треть постоянно в пуле, остальное - overflow на пики
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "30"))
+_connections_per_worker = max(1, DB_MAX_CONNECTIONS // WEB_CONCURRENCY)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(max(1, _connections_per_worker // 3))))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", str(max(0, _connections_per_worker - DB_POOL_SIZE))))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# Асинхронный engine для запросов из обработчиков, чтобы не блокировать event loop.
+# Соединения открываются лениво; схему создают миграции (python migrate.py), а не импорт модуля
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    poolclass=timed_pool(AsyncAdaptedQueuePool, "async"),
+    pool_pre_ping=True,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=3600,
     echo=False
 )
 
-# Пытаемся подключиться с retry
-max_retries = 5
-retry_delay = 2
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+instrument_engine(async_engine.sync_engine, "async")
+
+# Счетчик SQL-запросов текущего запроса (используется для поиска N+1 и в бенчмарках)
+_query_counter: ContextVar = ContextVar("query_counter", default=None)
+
+@event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    statements = _query_counter.get()
+    if statements is not None:
+        statements.append(statement)
 
-for attempt in range(max_retries):
+@contextmanager
+def count_queries():
+    statements = []
+    token = _query_counter.set(statements)
     try:
-        # Проверяем подключение
-        with engine.connect() as conn:
-            conn.execute(text("SELECT 1"))
-        logger.info("Successfully connected to database")
-        break
-    except Exception as e:
-        if attempt < max_retries - 1:
-            logger.warning(f"Database connection attempt {attempt + 1} failed: {e}")
-            logger.info(f"Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
-        else:
-            logger.error(f"Failed to connect to database after {max_retries} attempts")
-            raise
-
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        yield statements
+    finally:
+        _query_counter.reset(token)
 
 Base = declarative_base()
\ No newline at end of file
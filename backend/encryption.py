@@ -1,4 +1,7 @@
 from cryptography.fernet import Fernet
+from fastapi.concurrency import run_in_threadpool
+from typing import List
+from lru import TTLCache
 import os
 
 ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY")
@@ -17,4 +20,53 @@ def encrypt_message(message: str) -> str:
 
 def decrypt_message(encrypted_message: str) -> str:
     decrypted_bytes = cipher_suite.decrypt(encrypted_message.encode())
-    return decrypted_bytes.decode()
\ No newline at end of file
+    return decrypted_bytes.decode()
+
+
+class MessageCrypto:
+    # Пакетное шифрование/расшифровка сообщений с LRU-кэшем открытого текста по id сообщения.
+    # Содержимое сообщения после сохранения не меняется, поэтому кэш не нужно инвалидировать
+    def __init__(self, cipher: Fernet, cache_size: int, thread_threshold: int):
+        self.cipher = cipher
+        self.thread_threshold = thread_threshold
+        self._plaintexts = TTLCache(maxsize=cache_size, ttl=float("inf"))
+
+    def encrypt_many(self, texts: List[str]) -> List[str]:
+        return [self.cipher.encrypt(text.encode()).decode() for text in texts]
+
+    def remember(self, message_id: int, plaintext: str):
+        self._plaintexts.set(message_id, plaintext)
+
+    async def decrypt_messages(self, messages: List[dict]) -> List[dict]:
+        # Возвращает новые словари с расшифрованным content; исходные данные не изменяются
+        plaintexts = {}
+        missing = []
+        for msg in messages:
+            plaintext = self._plaintexts.get(msg["id"])
+            if plaintext is None:
+                missing.append(msg)
+            else:
+                plaintexts[msg["id"]] = plaintext
+
+        if missing:
+            ciphertexts = [msg["content"] for msg in missing]
+            # Большие страницы расшифровываем в пуле потоков, чтобы не держать event loop
+            if len(missing) >= self.thread_threshold:
+                decrypted = await run_in_threadpool(self._decrypt_many, ciphertexts)
+            else:
+                decrypted = self._decrypt_many(ciphertexts)
+            for msg, plaintext in zip(missing, decrypted):
+                plaintexts[msg["id"]] = plaintext
+                self._plaintexts.set(msg["id"], plaintext)
+
+        return [{**msg, "content": plaintexts[msg["id"]]} for msg in messages]
+
+    def _decrypt_many(self, ciphertexts: List[str]) -> List[str]:
+        return [self.cipher.decrypt(ciphertext.encode()).decode() for ciphertext in ciphertexts]
+
+
+message_crypto = MessageCrypto(
+    cipher_suite,
+    cache_size=int(os.getenv("DECRYPTED_CACHE_SIZE", "50000")),
+    thread_threshold=int(os.getenv("DECRYPT_THREAD_THRESHOLD", "100"))
+)
@@ -0,0 +1,36 @@
+import multiprocessing
+import os
+import shutil
+
+# Продакшен-запуск: gunicorn управляет процессами, каждый воркер - uvicorn со своим event loop.
+# Все параметры настраиваются через окружение
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "uvicorn_worker.UvicornWorker"
+# Сколько воркер ждет завершения запросов и lifespan (закрытие сокетов, запись очереди сообщений)
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+# Перезапуск воркеров после N запросов (0 - выключено), с разбросом, чтобы не рестартовали разом
+max_requests = int(os.getenv("MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "0"))
+accesslog = os.getenv("ACCESS_LOG") or None
+
+# Воркеры читают WEB_CONCURRENCY, чтобы поделить бюджет соединений с базой (database.py)
+os.environ["WEB_CONCURRENCY"] = str(workers)
+# Метрики нескольких процессов собираются через общий каталог (metrics.py)
+if workers > 1:
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+
+
+def on_starting(server):
+    # Значения прошлых запусков не должны попадать в /metrics
+    multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
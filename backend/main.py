@@ -1,30 +1,66 @@
-from fastapi import FastAPI, Depends, HTTPException, WebSocket, status, Request
+from fastapi import FastAPI, Depends, HTTPException, WebSocket, status, Request, Query
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from database import SessionLocal, engine
-from models import Base
-import models
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import count_queries
+import schemas
 from schemas import UserCreate, MessageCreate, ChatCreate
-from crud import create_user, create_message, get_messages, create_chat, get_user_chats, add_user_to_chat
-from auth import get_current_user, authenticate_user, create_access_token, get_db
-from websocket import handle_websocket
-from redis_client import get_online_users, publish_notification
-
-from prometheus_client import make_asgi_app, Counter, Histogram
-import time
-from sqlalchemy.exc import IntegrityError
+from crud import (
+    create_user, create_message, get_messages, create_chat, get_user_chats, add_user_to_chat,
+    get_chat_name_and_member_ids, mark_chat_read, search_messages
+)
+from membership import is_chat_member
+from passwords import HashingBusyError
+from rate_limit import RateLimitExceeded, limit_message
+from auth import get_current_user, get_websocket_user, authenticate_user, create_access_token, get_db
+from message_writer import message_writer
+from message_archive import run_partition_maintenance
+from websocket import handle_websocket, run_subscriber, run_presence_heartbeat, manager
+from redis_client import get_online_users, publish_notification, publish_notifications, publish_chat_event
+
+from metrics import MetricsMiddleware, metrics_app
+from contextlib import asynccontextmanager
+from typing import List, Optional
+import asyncio
+import json
+import os
 from dotenv import load_dotenv
 from fastapi.security import OAuth2PasswordRequestForm
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
-# Метрики
-REQUEST_COUNT = Counter('http_requests_total', 'Total HTTP requests', ['method', 'endpoint'])
-REQUEST_TIME = Histogram('http_request_duration_seconds', 'Duration of HTTP requests', ['method', 'endpoint'])
-
-app = FastAPI(root_path="/api")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Подписчик Redis доставляет сообщения и уведомления с других узлов в локальные сокеты,
+    # heartbeat поддерживает присутствие пользователей этого узла, обслуживание секций заводит секции messages
+    # на новые месяцы
+    tasks = [
+        asyncio.create_task(run_subscriber()),
+        asyncio.create_task(run_presence_heartbeat()),
+        asyncio.create_task(run_partition_maintenance()),
+    ]
+    message_writer.start()
+    yield
+    # Остановка: закрываем оставшиеся сокеты с кодом 1012 (клиент переподключается к другому узлу
+    # и дополучает пропущенное по since_seq) и дожидаемся снятия присутствия
+    await manager.close_all()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # Сообщения, принятые до остановки, должны попасть в базу
+    await message_writer.stop()
+
+# У всех эндпоинтов объявлен response_model: FastAPI сериализует ответ сразу в JSON-байты через
+# pydantic-core, без обхода объектов jsonable_encoder. Свой response_class (например ORJSONResponse)
+# отключил бы этот путь, поэтому класс ответа оставляем по умолчанию (см. benchmarks/serialization.py)
+app = FastAPI(root_path="/api", lifespan=lifespan)
+
+# Максимальный размер страницы истории сообщений
+MAX_PAGE_SIZE = 200
+MAX_SEARCH_PAGE_SIZE = 100
+# Добавлять в ответ заголовок X-DB-Queries с числом SQL-запросов (для поиска N+1 в CI и бенчмарках)
+EXPOSE_QUERY_COUNT = os.getenv("EXPOSE_QUERY_COUNT", "0") == "1"
 
 # Обработчик ошибок валидации
 @app.exception_handler(RequestValidationError)
@@ -58,40 +94,50 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         content={"detail": "Ошибка валидации данных"}
     )
 
-# Подключаем Prometheus middleware
-metrics_app = make_asgi_app()
-app.mount("/metrics", metrics_app)
-
-# Промежуточное ПО для сбора метрик
-@app.middleware("http")
-async def add_prometheus_metrics(request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    REQUEST_COUNT.labels(method=request.method, endpoint=request.url.path).inc()
-    REQUEST_TIME.labels(method=request.method, endpoint=request.url.path).observe(time.time() - start_time)
+# Пул bcrypt переполнен: отвечаем сразу, а не ставим запрос в бесконечную очередь
+@app.exception_handler(HashingBusyError)
+async def hashing_busy_handler(request: Request, exc: HashingBusyError):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "Сервер перегружен, повторите попытку позже"},
+        headers={"Retry-After": "1"}
+    )
+
+@app.exception_handler(RateLimitExceeded)
+async def rate_limit_handler(request: Request, exc: RateLimitExceeded):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "Слишком много сообщений, повторите попытку позже"},
+        headers={"Retry-After": str(exc.retry_after_seconds)}
+    )
+
+# Подключаем Prometheus: эндпоинт /metrics и сбор метрик запросов (метка - шаблон маршрута, а не путь)
+app.mount("/metrics", metrics_app())
+app.add_middleware(MetricsMiddleware)
+
+async def add_query_count_header(request, call_next):
+    with count_queries() as statements:
+        response = await call_next(request)
+    response.headers["X-DB-Queries"] = str(len(statements))
     return response
 
-# Создание таблиц с обработкой race condition
-try:
-    Base.metadata.create_all(bind=engine, checkfirst=True)
-except IntegrityError:
-    # Таблицы уже созданы другим инстансом
-    pass
+if EXPOSE_QUERY_COUNT:
+    app.middleware("http")(add_query_count_header)
 
-@app.post("/register/")
-def register_user(user: UserCreate, db: Session = Depends(get_db)):
+@app.post("/register/", response_model=schemas.RegisterResponse)
+async def register_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
     try:
-        db_user = create_user(db, user)
+        db_user = await create_user(db, user)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     return {"message": "User registered", "user_id": db_user.id}
 
-@app.post("/token")
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+@app.post("/token", response_model=schemas.Token)
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     import logging
     logging.info(f"Login attempt for user: {form_data.username}")
 
-    user_db = authenticate_user(db, form_data.username, form_data.password)
+    user_db = await authenticate_user(db, form_data.username, form_data.password)
     if not user_db:
         logging.warning(f"Failed login attempt for user: {form_data.username}")
         raise HTTPException(
@@ -104,42 +150,85 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
     logging.info(f"User logged in successfully: {form_data.username}")
     return {"access_token": access_token, "token_type": "bearer"}
 
-@app.post("/chats/")
-def create_new_chat(chat: ChatCreate, current_user = Depends(get_current_user), db: Session = Depends(get_db)):
-    new_chat = create_chat(db, chat, current_user.id)
-    for member_id in chat.members:
-        publish_notification(member_id, f"Вы были добавлены в чат '{new_chat.name}'")
+@app.post("/chats/", response_model=schemas.Chat)
+async def create_new_chat(chat: ChatCreate, current_user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    new_chat = await create_chat(db, chat, current_user.id)
+    await publish_notifications(chat.members, f"Вы были добавлены в чат '{new_chat.name}'")
     return new_chat
 
-@app.get("/chats/")
-def read_user_chats(current_user = Depends(get_current_user), db: Session = Depends(get_db)):
-    chats = get_user_chats(db, current_user.id)
+@app.get("/chats/", response_model=List[schemas.Chat])
+async def read_user_chats(current_user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    chats = await get_user_chats(db, current_user.id)
     return chats
 
-@app.post("/chats/{chat_id}/add-user/{user_id}")
-def add_user_to_group(chat_id: int, user_id: int, current_user = Depends(get_current_user), db: Session = Depends(get_db)):
-    add_user_to_chat(db, chat_id, user_id)
-    publish_notification(user_id, f"Вас добавили в чат {chat_id}")
+@app.post("/chats/{chat_id}/add-user/{user_id}", response_model=schemas.StatusMessage)
+async def add_user_to_group(chat_id: int, user_id: int, current_user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    # Добавлять в чат могут только его участники
+    if not await is_chat_member(db, chat_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Chat not found")
+    if await add_user_to_chat(db, chat_id, user_id):
+        await publish_notification(user_id, f"Вас добавили в чат {chat_id}")
     return {"message": f"User {user_id} added to chat {chat_id}"}
 
-@app.post("/messages/")
-def send_message(msg: MessageCreate, current_user = Depends(get_current_user), db: Session = Depends(get_db)):
-    message = create_message(db, msg, current_user.id)
-    chat = db.query(models.Chat).filter(models.Chat.id == msg.chat_id).first()
-    for member in chat.members:
-        if member.id != current_user.id:
-            publish_notification(member.id, f"Новое сообщение в '{chat.name}'")
-    return message
-
-@app.get("/messages/{chat_id}")
-def read_messages(chat_id: int, skip: int = 0, limit: int = 60, db: Session = Depends(get_db)):
-    messages = get_messages(db, chat_id, skip=skip, limit=limit)
-    return messages
+@app.post("/chats/{chat_id}/read", response_model=schemas.ReadState)
+async def mark_read(chat_id: int, body: schemas.MarkRead = schemas.MarkRead(), current_user = Depends(get_current_user),
+                    db: AsyncSession = Depends(get_db)):
+    state = await mark_chat_read(db, chat_id, current_user.id, body.message_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return state
+
+@app.post("/messages/", response_model=schemas.Message)
+async def send_message(msg: MessageCreate, current_user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    if not await is_chat_member(db, msg.chat_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Chat not found")
+    # Лимит проверяется до любой работы с базой; участие проверено раньше, чтобы посторонние
+    # не расходовали лимит чата
+    await limit_message(current_user.id, msg.chat_id)
+    chat_name, member_ids = await get_chat_name_and_member_ids(db, msg.chat_id)
+    # Соединение возвращаем в пул до ожидания group commit (см. MessageWriter.submit)
+    await db.close()
+    message = await create_message(msg, current_user, member_ids)
+    await publish_chat_event(msg.chat_id, json.dumps(message))
+    recipients = [member_id for member_id in member_ids if member_id != current_user.id]
+    await publish_notifications(recipients, f"Новое сообщение в '{chat_name}'")
+    # В событии чата и кэше остается шифротекст, а автору отвечаем открытым текстом, как остальные эндпоинты
+    return {**message, "content": msg.content}
+
+@app.get("/messages/{chat_id}", response_model=schemas.MessagePage)
+async def read_messages(chat_id: int, before_id: Optional[int] = None, after_id: Optional[int] = None,
+                        limit: int = Query(60, ge=1, le=MAX_PAGE_SIZE), current_user = Depends(get_current_user),
+                        db: AsyncSession = Depends(get_db)):
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Use either before_id or after_id")
+    # Проверка членства обычно обходится без запроса к базе (membership.py)
+    if not await is_chat_member(db, chat_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Chat not found")
+    messages = await get_messages(db, chat_id, before_id=before_id, after_id=after_id, limit=limit)
+    # Курсор следующей страницы: самое старое сообщение при листании назад, самое новое при листании вперед
+    next_cursor = None
+    if len(messages) == limit:
+        next_cursor = messages[-1]["id"] if after_id is not None else messages[0]["id"]
+    return {"messages": messages, "next_cursor": next_cursor}
+
+@app.get("/chats/{chat_id}/search", response_model=schemas.SearchPage)
+async def search_chat(chat_id: int, q: str = Query(..., min_length=1, max_length=500), cursor: Optional[str] = None,
+                      limit: int = Query(20, ge=1, le=MAX_SEARCH_PAGE_SIZE), current_user = Depends(get_current_user),
+                      db: AsyncSession = Depends(get_db)):
+    if not await is_chat_member(db, chat_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Chat not found")
+    try:
+        messages, next_cursor = await search_messages(db, chat_id, q, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"messages": messages, "next_cursor": next_cursor}
 
-@app.get("/online-users/")
-def online_users():
-    return get_online_users()
+@app.get("/online-users/", response_model=List[schemas.User])
+async def online_users():
+    return await get_online_users()
 
 @app.websocket("/ws/{chat_id}")
-async def websocket_endpoint(websocket: WebSocket, chat_id: str, current_user = Depends(get_current_user)):
-    await handle_websocket(websocket, chat_id, current_user.id)
\ No newline at end of file
+async def websocket_endpoint(websocket: WebSocket, chat_id: int, since_seq: Optional[int] = None,
+                             current_user = Depends(get_websocket_user)):
+    # since_seq: последний полученный клиентом seq чата, чтобы дополучить пропущенное после переподключения
+    await handle_websocket(websocket, chat_id, current_user, since_seq)
\ No newline at end of file
@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+from typing import List, Set
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from lru import TTLCache
+from models import chat_members
+from redis_client import (
+    get_cached_chat_ids, get_cached_member_ids, cache_chat_ids, cache_member_ids, add_memberships
+)
+
+logger = logging.getLogger(__name__)
+
+# Кэш членства для проверок доступа: user_id -> чаты и chat_id -> участники.
+# Уровни: словари процесса, затем множества в Redis, затем chat_members в базе
+# (по индексу (user_id, chat_id) для чатов пользователя и по первичному ключу для участников чата).
+# Локальные записи живут MEMBERSHIP_LOCAL_TTL и сбрасываются по событию из Redis при изменении состава
+MEMBERSHIP_LOCAL_TTL = float(os.getenv("MEMBERSHIP_LOCAL_TTL", "30"))
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "10000"))
+
+_user_chats = TTLCache(maxsize=MEMBERSHIP_CACHE_SIZE, ttl=MEMBERSHIP_LOCAL_TTL)
+_chat_members = TTLCache(maxsize=MEMBERSHIP_CACHE_SIZE, ttl=MEMBERSHIP_LOCAL_TTL)
+# Растет при каждом сбросе: загрузка, во время которой состав менялся, не сохраняет результат локально
+_generation = 0
+
+
+async def is_chat_member(db: AsyncSession, chat_id: int, user_id: int) -> bool:
+    return chat_id in await get_user_chat_ids(db, user_id)
+
+async def get_user_chat_ids(db: AsyncSession, user_id: int) -> Set[int]:
+    chat_ids = _user_chats.get(user_id)
+    if chat_ids is None:
+        generation = _generation
+        chat_ids = await _load(
+            user_id, get_cached_chat_ids, cache_chat_ids,
+            lambda: db.execute(select(chat_members.c.chat_id).where(chat_members.c.user_id == user_id))
+        )
+        if generation == _generation:
+            _user_chats.set(user_id, chat_ids)
+    return chat_ids
+
+async def get_chat_member_ids(db: AsyncSession, chat_id: int) -> List[int]:
+    member_ids = _chat_members.get(chat_id)
+    if member_ids is None:
+        generation = _generation
+        member_ids = await _load(
+            chat_id, get_cached_member_ids, cache_member_ids,
+            lambda: db.execute(select(chat_members.c.user_id).where(chat_members.c.chat_id == chat_id))
+        )
+        if generation == _generation:
+            _chat_members.set(chat_id, member_ids)
+    return list(member_ids)
+
+async def _load(key: int, get_cached, cache, query) -> frozenset:
+    # Версия множества читается вместе с ним, до запроса к базе (см. redis_client._cache_id_set_script)
+    version = None
+    try:
+        cached, version = await get_cached(key)
+        if cached is not None:
+            return frozenset(cached)
+    except Exception as e:
+        logger.warning(f"Membership cache unavailable: {e}")
+    ids = frozenset((await query()).scalars().all())
+    if version is not None:
+        try:
+            await cache(key, version, ids)
+        except Exception as e:
+            logger.warning(f"Failed to cache membership: {e}")
+    return ids
+
+async def members_added(chat_id: int, user_ids: List[int], new_chat: bool = False):
+    # Вызывается после коммита новых записей chat_members
+    forget_membership(chat_id, user_ids)
+    try:
+        await add_memberships(chat_id, user_ids, new_chat)
+    except Exception as e:
+        logger.warning(f"Failed to update membership cache for chat {chat_id}: {e}")
+
+def forget_membership(chat_id: int, user_ids: List[int]):
+    # Сбрасывает локальные записи; вызывается и по событию из Redis от других узлов
+    global _generation
+    _generation += 1
+    _chat_members.pop(chat_id)
+    for user_id in user_ids:
+        _user_chats.pop(user_id)
+
+def handle_membership_event(data: str):
+    event = json.loads(data)
+    forget_membership(event["chat_id"], event["user_ids"])
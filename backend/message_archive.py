@@ -0,0 +1,396 @@
+import argparse
+import asyncio
+import base64
+import bisect
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional
+
+import msgpack
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, delete, insert, select, text, type_coerce, LargeBinary
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.pool import NullPool
+
+from database import DATABASE_URL, async_engine
+from lru import TTLCache
+from models import Message, MessageArchiveSegment
+
+logger = logging.getLogger(__name__)
+
+# Холодный архив истории. В базе остаются последние MESSAGE_HOT_MONTHS месяцев; более старые месячные
+# секции messages выгружаются в сжатые сегменты (один файл на месяц) и удаляются из базы.
+# get_messages дочитывает сегменты через mmap, когда курсор уходит за горячее окно
+MESSAGE_ARCHIVE_DIR = os.getenv("MESSAGE_ARCHIVE_DIR", "/var/lib/messenger/archive")
+MESSAGE_HOT_MONTHS = int(os.getenv("MESSAGE_HOT_MONTHS", "6"))
+# Секции на будущие месяцы создаются заранее, чтобы новые сообщения не копились в секции DEFAULT
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv("MESSAGE_PARTITIONS_AHEAD", "3"))
+MESSAGE_PARTITION_CHECK_INTERVAL = float(os.getenv("MESSAGE_PARTITION_CHECK_INTERVAL", "3600"))
+DEFAULT_PARTITION = "messages_default"
+# Ключ pg_advisory_xact_lock, под которым создаются секции
+PARTITION_LOCK_KEY = 4_127_001
+ARCHIVE_BLOCK_ROWS = int(os.getenv("ARCHIVE_BLOCK_ROWS", "256"))
+ARCHIVE_COMPRESSION_LEVEL = int(os.getenv("ARCHIVE_COMPRESSION_LEVEL", "6"))
+# Как долго воркер не перечитывает каталог сегментов после архивации очередного месяца
+ARCHIVE_CATALOG_TTL = float(os.getenv("ARCHIVE_CATALOG_TTL", "60"))
+ARCHIVE_OPEN_SEGMENTS = int(os.getenv("ARCHIVE_OPEN_SEGMENTS", "64"))
+
+# Формат сегмента (числа little-endian):
+#   блоки  - zlib(msgpack([[id, timestamp_us, user_id, шифротекст], ...])): строки одного чата по возрастанию id
+#   индекс - запись на блок: chat_id, первый id, последний id, смещение, длина; отсортирован по (chat_id, id)
+#   хвост  - смещение индекса, число записей, сигнатура
+SEGMENT_MAGIC = b"MSGSEG01"
+_INDEX_ENTRY = struct.Struct("<qqqQI")
+_FOOTER = struct.Struct("<QI8s")
+_EPOCH = datetime(1970, 1, 1)
+
+ArchivedMessage = namedtuple("ArchivedMessage", "id timestamp user_id chat_id content")
+
+
+def month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def add_months(value: datetime, months: int) -> datetime:
+    years, month = divmod(value.month - 1 + months, 12)
+    return value.replace(year=value.year + years, month=month + 1)
+
+def partition_name(period_start: datetime) -> str:
+    return f"messages_p{period_start:%Y_%m}"
+
+
+class SegmentWriter:
+    # Строки должны приходить упорядоченными по (chat_id, id). Файл пишется во временный и появляется
+    # под своим именем только целиком
+    def __init__(self, path: str, block_rows: int = ARCHIVE_BLOCK_ROWS):
+        self.path = path
+        self.block_rows = block_rows
+        self.row_count = 0
+        self.min_id: Optional[int] = None
+        self.max_id: Optional[int] = None
+        self._tmp_path = f"{path}.tmp"
+        self._file = open(self._tmp_path, "wb")
+        self._index = []
+        self._block = []
+        self._block_chat_id = None
+
+    def add(self, message_id: int, timestamp: datetime, user_id: int, chat_id: int, ciphertext: bytes):
+        if self._block and (chat_id != self._block_chat_id or len(self._block) >= self.block_rows):
+            self._flush_block()
+        self._block_chat_id = chat_id
+        self._block.append([message_id, (timestamp - _EPOCH) // timedelta(microseconds=1), user_id, bytes(ciphertext)])
+        self.row_count += 1
+        self.min_id = message_id if self.min_id is None else min(self.min_id, message_id)
+        self.max_id = message_id if self.max_id is None else max(self.max_id, message_id)
+
+    def _flush_block(self):
+        data = zlib.compress(msgpack.packb(self._block), ARCHIVE_COMPRESSION_LEVEL)
+        self._index.append((self._block_chat_id, self._block[0][0], self._block[-1][0], self._file.tell(), len(data)))
+        self._file.write(data)
+        self._block = []
+
+    def close(self):
+        if self._block:
+            self._flush_block()
+        index_offset = self._file.tell()
+        for entry in self._index:
+            self._file.write(_INDEX_ENTRY.pack(*entry))
+        self._file.write(_FOOTER.pack(index_offset, len(self._index), SEGMENT_MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmp_path)
+
+
+class Segment:
+    # Сегмент, отображенный в память: индекс читается двоичным поиском прямо из mmap,
+    # распаковываются только блоки нужного чата
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index_offset, self._count, magic = _FOOTER.unpack_from(self._mmap, len(self._mmap) - _FOOTER.size)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f"{path} is not a message archive segment")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i: int) -> tuple:
+        return _INDEX_ENTRY.unpack_from(self._mmap, self._index_offset + i * _INDEX_ENTRY.size)
+
+    def read(self, chat_id: int, before_id: Optional[int] = None, after_id: Optional[int] = None,
+             limit: int = 60) -> List[ArchivedMessage]:
+        # Те же условия, что у _query_messages: до limit строк с id < before_id (самые новые)
+        # или с id > after_id (самые старые); результат в хронологическом порядке
+        lo = bisect.bisect_left(self, chat_id, key=_entry_chat_id)
+        hi = bisect.bisect_right(self, chat_id, key=_entry_chat_id)
+        rows = []
+        if after_id is not None:
+            start = max(lo, bisect.bisect_right(self, (chat_id, after_id), lo, hi, key=_entry_position) - 1)
+            for i in range(start, hi):
+                rows.extend(row for row in self._block(self[i]) if row[0] > after_id)
+                if len(rows) >= limit:
+                    break
+            rows = rows[:limit]
+        else:
+            end = hi if before_id is None else bisect.bisect_left(self, (chat_id, before_id), lo, hi, key=_entry_position)
+            for i in range(end - 1, lo - 1, -1):
+                rows[:0] = [row for row in self._block(self[i]) if before_id is None or row[0] < before_id]
+                if len(rows) >= limit:
+                    break
+            rows = rows[-limit:]
+        return [
+            ArchivedMessage(message_id, _EPOCH + timedelta(microseconds=timestamp_us), user_id, chat_id,
+                            base64.urlsafe_b64encode(ciphertext).decode())
+            for message_id, timestamp_us, user_id, ciphertext in rows
+        ]
+
+    def _block(self, entry: tuple) -> list:
+        _, _, _, offset, length = entry
+        return msgpack.unpackb(zlib.decompress(self._mmap[offset:offset + length]))
+
+
+def _entry_chat_id(entry: tuple) -> int:
+    return entry[0]
+
+def _entry_position(entry: tuple) -> tuple:
+    return entry[0], entry[1]
+
+
+class MessageArchive:
+    # Чтение архива из приложения. Каталог сегментов кэшируется в процессе на ARCHIVE_CATALOG_TTL,
+    # открытые сегменты - в LRU
+    def __init__(self, directory: str, catalog_ttl: float, open_segments: int):
+        self.directory = directory
+        self.catalog_ttl = catalog_ttl
+        self._catalog = None
+        self._catalog_loaded_at = 0.0
+        self._segments = TTLCache(maxsize=open_segments, ttl=float("inf"))
+
+    async def read(self, db: AsyncSession, chat_id: int, messages: List[dict], before_id: Optional[int] = None,
+                   after_id: Optional[int] = None, limit: int = 60) -> List[ArchivedMessage]:
+        # Архивные сообщения, которые могут попасть на страницу рядом с уже прочитанными из базы messages.
+        # Если база вернула полную страницу, архив нужен только при пересечении диапазонов id на границе месяцев
+        catalog = await self._load_catalog(db)
+        if not catalog:
+            return []
+        full_page = len(messages) >= limit
+        if after_id is None:
+            floor = messages[0]["id"] if full_page else None
+            candidates = [s for s in catalog
+                          if (before_id is None or s.min_id < before_id) and (floor is None or s.max_id > floor)]
+        else:
+            ceiling = messages[-1]["id"] if full_page else None
+            candidates = [s for s in catalog if s.max_id > after_id and (ceiling is None or s.min_id < ceiling)]
+        segments = [segment for segment in map(self._open, candidates) if segment is not None]
+        if not segments:
+            return []
+        return await run_in_threadpool(_read_segments, segments, chat_id, before_id, after_id, limit)
+
+    async def get(self, db: AsyncSession, chat_id: int, message_ids: List[int]) -> List[ArchivedMessage]:
+        # Точечное чтение по id (результаты поиска): сегмент выбирается по диапазону id из каталога
+        lookups = []
+        for entry in await self._load_catalog(db):
+            ids = [message_id for message_id in message_ids if entry.min_id <= message_id <= entry.max_id]
+            segment = self._open(entry) if ids else None
+            if segment is not None:
+                lookups.append((segment, ids))
+        if not lookups:
+            return []
+        return await run_in_threadpool(_get_from_segments, lookups, chat_id)
+
+    async def _load_catalog(self, db: AsyncSession):
+        if self._catalog is None or time.monotonic() - self._catalog_loaded_at > self.catalog_ttl:
+            result = await db.execute(
+                select(MessageArchiveSegment.min_id, MessageArchiveSegment.max_id, MessageArchiveSegment.path)
+                .order_by(MessageArchiveSegment.max_id.desc())
+            )
+            self._catalog = result.all()
+            self._catalog_loaded_at = time.monotonic()
+        return self._catalog
+
+    def _open(self, entry) -> Optional[Segment]:
+        segment = self._segments.get(entry.path)
+        if segment is None:
+            try:
+                segment = Segment(os.path.join(self.directory, entry.path))
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to open archive segment {entry.path}: {e}")
+                return None
+            self._segments.set(entry.path, segment)
+        return segment
+
+
+def _read_segments(segments: List[Segment], chat_id: int, before_id: Optional[int], after_id: Optional[int],
+                   limit: int) -> List[ArchivedMessage]:
+    rows = sorted(
+        (row for segment in segments for row in segment.read(chat_id, before_id, after_id, limit)),
+        key=lambda row: row.id
+    )
+    return rows[:limit] if after_id is not None else rows[-limit:]
+
+
+def _get_from_segments(lookups: List[tuple], chat_id: int) -> List[ArchivedMessage]:
+    found = []
+    for segment, message_ids in lookups:
+        for message_id in message_ids:
+            found.extend(row for row in segment.read(chat_id, after_id=message_id - 1, limit=1) if row.id == message_id)
+    return found
+
+
+message_archive = MessageArchive(MESSAGE_ARCHIVE_DIR, ARCHIVE_CATALOG_TTL, ARCHIVE_OPEN_SEGMENTS)
+
+
+# Обслуживание: создание секций и архивация. Запускается по расписанию (python message_archive.py),
+# ensure_partitions дополнительно вызывает migrate.py при каждом развертывании
+
+def is_partitioned(conn) -> bool:
+    if conn.dialect.name != "postgresql":
+        return False
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = 'messages'"
+    )).first() is not None
+
+def _existing_partitions(conn) -> set:
+    result = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'messages'"
+    ))
+    return set(result.scalars())
+
+def create_partition(conn, period_start: datetime, from_default: bool = False):
+    period_end = add_months(period_start, 1)
+    name = partition_name(period_start)
+    bounds = f"FROM ('{period_start:%Y-%m-%d}') TO ('{period_end:%Y-%m-%d}')"
+    if not from_default:
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages FOR VALUES {bounds}"))
+        return
+    # Строки месяца уже лежат в секции DEFAULT, и PostgreSQL не создаст пересекающуюся с ними секцию.
+    # Отсоединяем DEFAULT, создаем секцию, переносим в нее строки и присоединяем DEFAULT обратно
+    in_period = f"timestamp >= '{period_start:%Y-%m-%d}' AND timestamp < '{period_end:%Y-%m-%d}'"
+    conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {DEFAULT_PARTITION}"))
+    conn.execute(text(f"CREATE TABLE {name} PARTITION OF messages FOR VALUES {bounds}"))
+    conn.execute(text(
+        f"INSERT INTO messages (id, content, timestamp, user_id, chat_id) "
+        f"SELECT id, content, timestamp, user_id, chat_id FROM {DEFAULT_PARTITION} WHERE {in_period}"
+    ))
+    conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_period}"))
+    conn.execute(text(f"ALTER TABLE messages ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    logger.info(f"Moved messages of {period_start:%Y-%m} from {DEFAULT_PARTITION} to {name}")
+
+def ensure_partitions(conn, months_ahead: int = MESSAGE_PARTITIONS_AHEAD):
+    # Секции на текущий и ближайшие месяцы, а также на месяцы, строки которых уже попали в DEFAULT.
+    # Вызывается из migrate.py, message_archive.py и периодически из каждого воркера, поэтому под advisory lock
+    if not is_partitioned(conn):
+        return
+    conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": PARTITION_LOCK_KEY})
+    existing = _existing_partitions(conn)
+    current = month_start(datetime.utcnow())
+    months = {add_months(current, i) for i in range(months_ahead + 1)}
+    stranded = set()
+    if DEFAULT_PARTITION in existing:
+        stranded = set(conn.execute(text(
+            f"SELECT DISTINCT date_trunc('month', timestamp) FROM {DEFAULT_PARTITION}"
+        )).scalars())
+    for period_start in sorted(months | stranded):
+        if partition_name(period_start) not in existing:
+            create_partition(conn, period_start, from_default=period_start in stranded)
+
+async def run_partition_maintenance():
+    # Без перезапуска воркеров секции на новые месяцы создаются здесь, а не только при развертывании
+    while True:
+        await asyncio.sleep(MESSAGE_PARTITION_CHECK_INTERVAL)
+        try:
+            async with async_engine.begin() as conn:
+                await conn.run_sync(ensure_partitions)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Partition maintenance failed: {e}")
+
+def months_to_archive(conn, cutoff: datetime) -> Iterator[datetime]:
+    # Месяцы до cutoff, в которых есть сообщения или под которые заведена секция
+    months = set()
+    if is_partitioned(conn):
+        for name in _existing_partitions(conn):
+            if name.startswith("messages_p"):
+                period_start = datetime.strptime(name[len("messages_p"):], "%Y_%m")
+                if period_start < cutoff:
+                    months.add(period_start)
+    oldest = conn.execute(select(Message.timestamp).where(Message.timestamp < cutoff)
+                          .order_by(Message.timestamp).limit(1)).scalar()
+    if oldest is not None:
+        period_start = month_start(oldest)
+        while period_start < cutoff:
+            months.add(period_start)
+            period_start = add_months(period_start, 1)
+    return iter(sorted(months))
+
+def archive_month(conn, period_start: datetime, directory: str = MESSAGE_ARCHIVE_DIR) -> int:
+    # Выгружает месяц в сегмент и удаляет его из базы одной транзакцией с записью в каталог.
+    # Повторный запуск после сбоя перезаписывает недописанный файл
+    period_end = add_months(period_start, 1)
+    file_name = f"messages-{period_start:%Y-%m}.seg"
+    in_period = (Message.timestamp >= period_start) & (Message.timestamp < period_end)
+    rows = conn.execution_options(stream_results=True, yield_per=ARCHIVE_BLOCK_ROWS * 4).execute(
+        select(Message.id, Message.timestamp, Message.user_id, Message.chat_id, type_coerce(Message.content, LargeBinary))
+        .where(in_period)
+        .order_by(Message.chat_id, Message.id)
+    )
+    writer = SegmentWriter(os.path.join(directory, file_name))
+    try:
+        for row in rows:
+            writer.add(*row)
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+
+    if writer.row_count:
+        conn.execute(insert(MessageArchiveSegment).values(
+            period_start=period_start, min_id=writer.min_id, max_id=writer.max_id,
+            row_count=writer.row_count, path=file_name
+        ))
+    else:
+        os.remove(writer.path)
+    name = partition_name(period_start)
+    if is_partitioned(conn) and name in _existing_partitions(conn):
+        # Удаление секции целиком вместо DELETE: без мертвых строк и VACUUM
+        conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+        conn.execute(text(f"DROP TABLE {name}"))
+    else:
+        conn.execute(delete(Message).where(in_period))
+    conn.commit()
+    return writer.row_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create upcoming message partitions and archive old ones")
+    parser.add_argument("--hot-months", type=int, default=MESSAGE_HOT_MONTHS,
+                        help="months of history kept in the database")
+    parser.add_argument("--directory", default=MESSAGE_ARCHIVE_DIR)
+    args = parser.parse_args()
+
+    os.makedirs(args.directory, exist_ok=True)
+    engine = create_engine(DATABASE_URL, poolclass=NullPool)
+    cutoff = add_months(month_start(datetime.utcnow()), -args.hot_months)
+    with engine.connect() as conn:
+        ensure_partitions(conn)
+        conn.commit()
+        for period_start in months_to_archive(conn, cutoff):
+            archived = archive_month(conn, period_start, args.directory)
+            logger.info(f"Archived {archived} messages from {period_start:%Y-%m}")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+from typing import List, Tuple
+from sqlalchemy import insert
+from database import AsyncSessionLocal
+from encryption import message_crypto
+from models import Message, message_search_tokens
+from search_index import index_rows
+
+logger = logging.getLogger(__name__)
+
+# Group commit: сообщения копятся не дольше MESSAGE_BATCH_INTERVAL_MS или до MESSAGE_BATCH_SIZE штук
+# и записываются одним INSERT ... RETURNING в одной транзакции
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+MESSAGE_BATCH_INTERVAL_MS = float(os.getenv("MESSAGE_BATCH_INTERVAL_MS", "5"))
+# Ограничение очереди: при переполнении отправители ждут, а не копят память
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", "10000"))
+
+PendingMessage = Tuple[int, int, str, asyncio.Future]
+
+
+class MessageWriter:
+    def __init__(self, batch_size: int, interval: float, queue_size: int):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._batch_ready = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Дописываем все, что уже принято, и дожидаемся завершения фоновой задачи
+        if self._task is None or self._task.done():
+            return
+        await self._queue.put(None)
+        self._batch_ready.set()
+        await self._task
+        self._task = None
+        self._stopping = False
+
+    async def submit(self, chat_id: int, user_id: int, content: str) -> Message:
+        # Возвращает сохраненное сообщение (id, timestamp, шифротекст) после коммита его пачки.
+        # Вызывающий не должен держать соединение из пула, пока ждет: при всплеске ожидающие заняли бы
+        # все соединения, и пачке, которую они ждут, не из чего было бы взять свое
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((chat_id, user_id, content, future))
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+        return await future
+
+    async def _run(self):
+        while not self._stopping:
+            first = await self._queue.get()
+            if first is None:
+                break
+            if self._queue.qsize() + 1 < self.batch_size:
+                self._batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush([first] + self._drain(self.batch_size - 1))
+        # Остановка: записываем то, что успело попасть в очередь
+        while batch := self._drain(self.batch_size):
+            await self._flush(batch)
+
+    def _drain(self, limit: int) -> List[PendingMessage]:
+        batch = []
+        while len(batch) < limit and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is None:
+                self._stopping = True
+                continue
+            batch.append(item)
+        return batch
+
+    async def _flush(self, batch: List[PendingMessage]):
+        try:
+            messages = await self._insert(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                _fail(batch[0][3], e)
+                return
+            # Одно некорректное сообщение не должно ронять всю пачку: повторяем по одному
+            logger.warning(f"Batch insert of {len(batch)} messages failed, retrying one by one: {e}")
+            for item in batch:
+                await self._flush([item])
+            return
+        for (_, _, _, future), message in zip(batch, messages):
+            if not future.done():
+                future.set_result(message)
+
+    async def _insert(self, batch: List[PendingMessage]) -> List[Message]:
+        ciphertexts = message_crypto.encrypt_many([content for _, _, content, _ in batch])
+        rows = [
+            {"content": ciphertext, "user_id": user_id, "chat_id": chat_id}
+            for (chat_id, user_id, _, _), ciphertext in zip(batch, ciphertexts)
+        ]
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                insert(Message).returning(Message.id, Message.timestamp, sort_by_parameter_order=True),
+                rows
+            )
+            saved = result.all()
+            # Поисковый индекс пополняется в той же транзакции, что и сами сообщения
+            entries = [
+                entry
+                for row, (chat_id, _, content, _) in zip(saved, batch)
+                for entry in index_rows(chat_id, row.id, content)
+            ]
+            if entries:
+                await db.execute(insert(message_search_tokens), entries)
+            await db.commit()
+        return [
+            Message(id=row.id, timestamp=row.timestamp, **values)
+            for row, values in zip(saved, rows)
+        ]
+
+
+def _fail(future: asyncio.Future, error: Exception):
+    if not future.done():
+        future.set_exception(error)
+
+
+message_writer = MessageWriter(
+    batch_size=MESSAGE_BATCH_SIZE,
+    interval=MESSAGE_BATCH_INTERVAL_MS / 1000,
+    queue_size=MESSAGE_QUEUE_SIZE
+)
@@ -0,0 +1,141 @@
+import os
+import time
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, make_asgi_app, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Все метрики процесса. Метки только с ограниченным набором значений: шаблон маршрута вместо пути,
+# имя команды Redis, тип SQL-запроса. При нескольких воркерах задайте PROMETHEUS_MULTIPROC_DIR
+# (пустой каталог, общий для воркеров): /metrics тогда суммирует значения всех процессов
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+REQUEST_COUNT = Counter('http_requests_total', 'Total HTTP requests', ['method', 'endpoint', 'status'])
+REQUEST_TIME = Histogram('http_request_duration_seconds', 'Duration of HTTP requests', ['method', 'endpoint'])
+
+DB_POOL_WAIT = Histogram(
+    'db_pool_checkout_wait_seconds', 'Time spent waiting for a connection from the pool', ['engine'],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+DB_POOL_IN_USE = Gauge(
+    'db_pool_connections_in_use', 'Connections checked out from the pool', ['engine'], multiprocess_mode='livesum'
+)
+DB_QUERY_TIME = Histogram(
+    'db_query_duration_seconds', 'SQL statement execution time', ['engine', 'operation'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+
+REDIS_COMMAND_TIME = Histogram(
+    'redis_command_duration_seconds', 'Redis command latency including the round trip', ['command'],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+)
+
+WS_CONNECTIONS = Gauge('ws_connections', 'Open WebSocket connections', multiprocess_mode='livesum')
+WS_FANOUT = Histogram(
+    'ws_broadcast_fanout', 'Local sockets a single event was delivered to', ['kind'],
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+)
+WS_SEND_QUEUE_DEPTH = Histogram(
+    'ws_send_queue_depth', 'Frames waiting in a socket send queue after enqueue',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+)
+WS_DROPPED_FRAMES = Counter('ws_dropped_frames_total', 'Frames dropped because a send queue was full')
+
+# source: local - отклонено проверкой процесса без обращения к Redis, redis - общим лимитом
+RATE_LIMITED = Counter(
+    'rate_limited_total', 'Requests and WebSocket frames rejected by a rate limit', ['limit', 'scope', 'source']
+)
+
+SQL_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+
+def metrics_app():
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return make_asgi_app(registry=registry)
+    return make_asgi_app()
+
+
+def mark_process_dead(pid: int):
+    # Вызывается менеджером процессов при завершении воркера, чтобы его livesum-гейджи не висели в /metrics
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+class MetricsMiddleware:
+    # Чистый ASGI middleware: без лишней задачи и копирования тела ответа, как у BaseHTTPMiddleware
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Маршрутизатор кладет найденный маршрут в scope; непойманные пути не плодят отдельные серии
+            route = scope.get("route")
+            endpoint = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            REQUEST_COUNT.labels(method, endpoint, status_code).inc()
+            REQUEST_TIME.labels(method, endpoint).observe(time.perf_counter() - start_time)
+
+
+def timed_pool(pool_class, engine_name: str):
+    # Пул, замеряющий ожидание свободного соединения. Класс пула переживает engine.dispose(),
+    # в отличие от обертки над экземпляром
+    wait = DB_POOL_WAIT.labels(engine_name)
+
+    class TimedPool(pool_class):
+        def _do_get(self):
+            start_time = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                wait.observe(time.perf_counter() - start_time)
+
+    TimedPool.__name__ = f"Timed{pool_class.__name__}"
+    return TimedPool
+
+
+def instrument_engine(engine: Engine, engine_name: str):
+    in_use = DB_POOL_IN_USE.labels(engine_name)
+    query_time = {operation: DB_QUERY_TIME.labels(engine_name, operation) for operation in SQL_OPERATIONS | {"OTHER"}}
+
+    @event.listens_for(engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        in_use.inc()
+
+    @event.listens_for(engine, "checkin")
+    def _on_checkin(dbapi_connection, connection_record):
+        in_use.dec()
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        start_times = conn.info.get("query_start_time")
+        if not start_times:
+            return
+        operation = statement.lstrip()[:6].upper()
+        query_time.get(operation, query_time["OTHER"]).observe(time.perf_counter() - start_times.pop())
+
+    @event.listens_for(engine, "handle_error")
+    def _on_error(exception_context):
+        # Упавший запрос не доходит до after_cursor_execute
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("query_start_time"):
+            connection.info["query_start_time"].pop()
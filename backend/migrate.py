@@ -0,0 +1,58 @@
+import logging
+import os
+import time
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.pool import NullPool
+from database import DATABASE_URL
+from message_archive import ensure_partitions
+
+# Одноразовый шаг перед запуском воркеров: дождаться базы и применить миграции.
+# Запускается один раз на развертывание (сервис migrate в docker-compose), а не в каждом воркере
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MIGRATE_MAX_RETRIES = int(os.getenv("MIGRATE_MAX_RETRIES", "5"))
+MIGRATE_RETRY_DELAY = float(os.getenv("MIGRATE_RETRY_DELAY", "2"))
+# Ревизия, соответствующая схеме, которую раньше создавал create_all
+BASELINE_REVISION = "0001"
+
+
+def wait_for_database(engine):
+    for attempt in range(MIGRATE_MAX_RETRIES):
+        try:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            logger.info("Successfully connected to database")
+            return
+        except Exception as e:
+            if attempt < MIGRATE_MAX_RETRIES - 1:
+                logger.warning(f"Database connection attempt {attempt + 1} failed: {e}")
+                logger.info(f"Retrying in {MIGRATE_RETRY_DELAY} seconds...")
+                time.sleep(MIGRATE_RETRY_DELAY)
+            else:
+                logger.error(f"Failed to connect to database after {MIGRATE_MAX_RETRIES} attempts")
+                raise
+
+
+def main():
+    engine = create_engine(DATABASE_URL, poolclass=NullPool)
+    wait_for_database(engine)
+    config = Config(os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini"))
+
+    with engine.connect() as conn:
+        tables = set(inspect(conn).get_table_names())
+    if "users" in tables and "alembic_version" not in tables:
+        # База создана до появления миграций: не пересоздаем таблицы, а отмечаем базовую ревизию
+        logger.info(f"Existing schema without migration history, stamping revision {BASELINE_REVISION}")
+        command.stamp(config, BASELINE_REVISION)
+    command.upgrade(config, "head")
+    # Секции messages на текущий и ближайшие месяцы
+    with engine.begin() as conn:
+        ensure_partitions(conn)
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+"""messages (chat_id, id) index for keyset pagination
+
+create_all не добавлял индекс в уже существующую таблицу, поэтому он может отсутствовать
+в базах, помеченных ревизией 0001.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_messages_chat_id_id", "messages", ["chat_id", "id"], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index("ix_messages_chat_id_id", table_name="messages")
@@ -0,0 +1,28 @@
+"""chat_members.last_read_message_id for unread counters
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("chat_members") as batch_op:
+        batch_op.add_column(sa.Column("last_read_message_id", sa.Integer(), nullable=True))
+    # Существующие участники начинают с прочитанной историей, а не со всех сообщений чата
+    op.execute(
+        "UPDATE chat_members SET last_read_message_id = "
+        "(SELECT MAX(messages.id) FROM messages WHERE messages.chat_id = chat_members.chat_id)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table("chat_members") as batch_op:
+        batch_op.drop_column("last_read_message_id")
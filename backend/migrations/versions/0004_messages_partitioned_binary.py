@@ -0,0 +1,156 @@
+"""messages: binary ciphertext, monthly partitions and archive catalog
+
+Шифротекст хранится как bytea/BLOB (сырые байты токена Fernet вместо base64-текста).
+В PostgreSQL таблица пересоздается секционированной по месяцам timestamp с копированием данных;
+первичный ключ секционированной таблицы обязан включать ключ секционирования, поэтому он (id, timestamp).
+На больших базах копирование занимает время, миграцию стоит запускать в окно обслуживания.
+Сообщения, уже выгруженные в архив, при откате не возвращаются.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+import base64
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+PARTITIONS_AHEAD = 3
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    op.execute("UPDATE messages SET timestamp = CURRENT_TIMESTAMP WHERE timestamp IS NULL")
+    if op.get_bind().dialect.name == "postgresql":
+        _partition_postgresql()
+    else:
+        with op.batch_alter_table("messages") as batch_op:
+            batch_op.alter_column("content", type_=sa.LargeBinary(), existing_type=sa.String(), existing_nullable=False)
+            batch_op.alter_column("timestamp", existing_type=sa.DateTime(), nullable=False)
+        _convert_content(sa.String(), sa.LargeBinary(), base64.urlsafe_b64decode)
+
+    op.create_table(
+        "message_archive_segments",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("period_start", sa.DateTime(), nullable=False, unique=True),
+        sa.Column("min_id", sa.Integer(), nullable=False),
+        sa.Column("max_id", sa.Integer(), nullable=False),
+        sa.Column("row_count", sa.Integer(), nullable=False),
+        sa.Column("path", sa.String(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+    )
+
+
+def downgrade():
+    op.drop_table("message_archive_segments")
+    if op.get_bind().dialect.name == "postgresql":
+        _unpartition_postgresql()
+    else:
+        _convert_content(sa.LargeBinary(), sa.LargeBinary(), base64.urlsafe_b64encode)
+        with op.batch_alter_table("messages") as batch_op:
+            batch_op.alter_column("timestamp", existing_type=sa.DateTime(), nullable=True)
+            batch_op.alter_column("content", type_=sa.String(), existing_type=sa.LargeBinary(), existing_nullable=False)
+
+
+def _partition_postgresql():
+    op.execute("ALTER TABLE messages RENAME TO messages_unpartitioned")
+    op.execute("ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey")
+    op.execute("ALTER INDEX ix_messages_id RENAME TO ix_messages_unpartitioned_id")
+    op.execute("ALTER INDEX ix_messages_chat_id_id RENAME TO ix_messages_unpartitioned_chat_id_id")
+    op.execute("""
+        CREATE TABLE messages (
+            id integer NOT NULL DEFAULT nextval('messages_id_seq'),
+            content bytea NOT NULL,
+            timestamp timestamp without time zone NOT NULL,
+            user_id integer REFERENCES users (id),
+            chat_id integer REFERENCES chats (id),
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """)
+
+    oldest, newest = op.get_bind().execute(sa.text(
+        "SELECT min(timestamp), max(timestamp) FROM messages_unpartitioned"
+    )).first()
+    now = datetime.utcnow()
+    period_start = _month_start(oldest or now)
+    last = _add_months(_month_start(max(newest or now, now)), PARTITIONS_AHEAD)
+    while period_start <= last:
+        period_end = _add_months(period_start, 1)
+        op.execute(
+            f"CREATE TABLE messages_p{period_start:%Y_%m} PARTITION OF messages "
+            f"FOR VALUES FROM ('{period_start:%Y-%m-%d}') TO ('{period_end:%Y-%m-%d}')"
+        )
+        period_start = period_end
+    # Страховка на случай, если секции на очередной месяц не созданы заранее. Попавшие сюда строки
+    # message_archive.ensure_partitions переносит в секцию месяца, когда создает ее
+    op.execute("CREATE TABLE messages_default PARTITION OF messages DEFAULT")
+
+    # Fernet использует base64url, decode в PostgreSQL понимает только обычный алфавит
+    op.execute("""
+        INSERT INTO messages (id, content, timestamp, user_id, chat_id)
+        SELECT id, decode(translate(content, '-_', '+/'), 'base64'), timestamp, user_id, chat_id
+        FROM messages_unpartitioned
+    """)
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+    op.execute("DROP TABLE messages_unpartitioned")
+    op.create_index("ix_messages_id", "messages", ["id"])
+    op.create_index("ix_messages_chat_id_id", "messages", ["chat_id", "id"])
+
+
+def _unpartition_postgresql():
+    op.execute("ALTER TABLE messages RENAME TO messages_partitioned")
+    op.execute("ALTER INDEX ix_messages_id RENAME TO ix_messages_partitioned_id")
+    op.execute("ALTER INDEX ix_messages_chat_id_id RENAME TO ix_messages_partitioned_chat_id_id")
+    op.execute("ALTER TABLE messages_partitioned RENAME CONSTRAINT messages_pkey TO messages_partitioned_pkey")
+    op.execute("""
+        CREATE TABLE messages (
+            id integer NOT NULL DEFAULT nextval('messages_id_seq') PRIMARY KEY,
+            content varchar NOT NULL,
+            timestamp timestamp without time zone,
+            user_id integer REFERENCES users (id),
+            chat_id integer REFERENCES chats (id)
+        )
+    """)
+    # encode разбивает base64 на строки по 76 символов; переводы строк удаляются вместе со сменой алфавита
+    op.execute("""
+        INSERT INTO messages (id, content, timestamp, user_id, chat_id)
+        SELECT id, translate(encode(content, 'base64'), E'+/\\n', '-_'), timestamp, user_id, chat_id
+        FROM messages_partitioned
+    """)
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+    op.execute("DROP TABLE messages_partitioned")
+    op.create_index("ix_messages_id", "messages", ["id"])
+    op.create_index("ix_messages_chat_id_id", "messages", ["chat_id", "id"])
+
+
+def _convert_content(read_type, write_type, convert):
+    # Перекодирование содержимого на стороне Python пачками по id (для баз без секционирования)
+    conn = op.get_bind()
+    source = sa.table("messages", sa.column("id", sa.Integer()), sa.column("content", read_type))
+    target = sa.table("messages", sa.column("id", sa.Integer()), sa.column("content", write_type))
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(source.c.id, source.c.content).where(source.c.id > last_id).order_by(source.c.id).limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        conn.execute(
+            sa.update(target).where(target.c.id == sa.bindparam("message_id")).values(content=sa.bindparam("value")),
+            [{"message_id": row.id, "value": convert(row.content)} for row in rows]
+        )
+        last_id = rows[-1].id
+
+
+def _month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add_months(value: datetime, months: int) -> datetime:
+    years, month = divmod(value.month - 1 + months, 12)
+    return value.replace(year=value.year + years, month=month + 1)
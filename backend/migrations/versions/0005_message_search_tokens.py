@@ -0,0 +1,30 @@
+"""message_search_tokens blind index for message search
+
+Существующие сообщения индексируются отдельно: python search_index.py.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "message_search_tokens",
+        sa.Column("chat_id", sa.Integer(), primary_key=True),
+        sa.Column("token_hash", sa.BigInteger(), primary_key=True),
+        sa.Column("message_id", sa.Integer(), primary_key=True),
+        sa.Column("weight", sa.SmallInteger(), nullable=False),
+    )
+    op.create_index("ix_message_search_tokens_message_id", "message_search_tokens", ["message_id"])
+
+
+def downgrade():
+    op.drop_table("message_search_tokens")
@@ -0,0 +1,23 @@
+"""chat_members (user_id, chat_id) index for per-user membership lookups
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # В PostgreSQL индекс строится без блокировки записи в chat_members
+    with op.get_context().autocommit_block():
+        op.create_index("ix_chat_members_user_id_chat_id", "chat_members", ["user_id", "chat_id"],
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index("ix_chat_members_user_id_chat_id", table_name="chat_members")
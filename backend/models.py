@@ -1,13 +1,48 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, Table
+from sqlalchemy import (
+    Column, Integer, String, DateTime, ForeignKey, Boolean, Table, Index, LargeBinary, BigInteger, SmallInteger
+)
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
 from datetime import datetime
 from database import Base
+import base64
+
+
+class Ciphertext(TypeDecorator):
+    # Токен Fernet хранится в базе сырыми байтами: base64-текст занимал бы на треть больше места.
+    # Приложение по-прежнему работает со строковым токеном
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else base64.urlsafe_b64decode(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else base64.urlsafe_b64encode(value).decode()
+
 
 chat_members = Table(
     'chat_members',
     Base.metadata,
     Column('chat_id', Integer, ForeignKey('chats.id'), primary_key=True),
-    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True)
+    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
+    # Последнее прочитанное участником сообщение; источник истины для счетчиков непрочитанного в Redis
+    Column('last_read_message_id', Integer, nullable=True),
+    # Первичный ключ начинается с chat_id; чаты пользователя ищутся по этому индексу
+    Index('ix_chat_members_user_id_chat_id', 'user_id', 'chat_id')
+)
+
+# Слепой поисковый индекс (search_index.py): строка на каждое слово сообщения, слово хранится как HMAC.
+# Внешнего ключа на messages нет: в секционированной таблице id не уникален сам по себе,
+# а строки архивированных сообщений остаются в индексе
+message_search_tokens = Table(
+    'message_search_tokens',
+    Base.metadata,
+    Column('chat_id', Integer, primary_key=True),
+    Column('token_hash', BigInteger, primary_key=True),
+    Column('message_id', Integer, primary_key=True),
+    Column('weight', SmallInteger, nullable=False),
+    Index('ix_message_search_tokens_message_id', 'message_id')
 )
 
 class User(Base):
@@ -33,13 +68,31 @@ class Chat(Base):
     messages = relationship("Message", back_populates="chat")
 
 class Message(Base):
+    # В PostgreSQL таблица секционирована по месяцам timestamp (миграция 0004, первичный ключ там (id, timestamp)),
+    # старые секции выгружаются в сжатые сегменты архива (message_archive.py)
     __tablename__ = "messages"
+    __table_args__ = (
+        # Keyset-пагинация истории чата: WHERE chat_id = ? AND id < ? ORDER BY id DESC
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    content = Column(String, nullable=False)  # Шифрованный контент
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    content = Column(Ciphertext, nullable=False)  # Шифрованный контент
+    timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"))
     chat_id = Column(Integer, ForeignKey("chats.id"))
 
     user = relationship("User", back_populates="messages")
-    chat = relationship("Chat", back_populates="messages")
\ No newline at end of file
+    chat = relationship("Chat", back_populates="messages")
+
+class MessageArchiveSegment(Base):
+    # Каталог архивных сегментов: какой месяц и диапазон id сообщений лежит в каком файле
+    __tablename__ = "message_archive_segments"
+
+    id = Column(Integer, primary_key=True)
+    period_start = Column(DateTime, unique=True, nullable=False)
+    min_id = Column(Integer, nullable=False)
+    max_id = Column(Integer, nullable=False)
+    row_count = Column(Integer, nullable=False)
+    path = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
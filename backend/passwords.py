@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from passlib.context import CryptContext
+
+# Настраиваем контекст паролей с явными параметрами (один на процесс)
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=12,
+    bcrypt__ident="2b"
+)
+
+logger = logging.getLogger(__name__)
+
+# bcrypt отпускает GIL, поэтому хватает пула потоков. Отдельный пул не дает
+# всплеску /token и /register/ занять общий threadpool и event loop.
+# Ядра делятся между воркерами gunicorn так же, как соединения с базой в database.py
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))))
+# Сколько операций может ждать в очереди сверх работающих; остальным сразу отвечаем 429
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", str(BCRYPT_WORKERS * 4)))
+
+_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+_pending = 0
+
+
+class HashingBusyError(Exception):
+    pass
+
+
+async def hash_password(password: str) -> str:
+    return await _run(_hash_password, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _run(_verify_password, plain_password, hashed_password)
+
+
+async def _run(func, *args):
+    global _pending
+    if _pending >= BCRYPT_WORKERS + BCRYPT_MAX_PENDING:
+        raise HashingBusyError("Too many password operations in progress")
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _pending -= 1
+
+
+def _hash_password(password: str) -> str:
+    try:
+        hashed_password = pwd_context.hash(password)
+        logger.info("Password hashed successfully")
+    except Exception as e:
+        logger.error(f"Error hashing password: {e}")
+        # Пробуем альтернативный подход
+        try:
+            import bcrypt
+            salt = bcrypt.gensalt()
+            hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+            logger.info("Password hashed using direct bcrypt")
+        except Exception as e2:
+            logger.error(f"Alternative hashing also failed: {e2}")
+            raise ValueError(f"Cannot hash password: {str(e)}")
+    return hashed_password
+
+
+def _verify_password(plain_password: str, hashed_password: str) -> bool:
+    try:
+        return pwd_context.verify(plain_password, hashed_password)
+    except Exception as e:
+        # Пробуем прямую проверку через bcrypt
+        try:
+            import bcrypt
+            return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+        except:
+            return False
@@ -0,0 +1,94 @@
+import json
+import msgpack
+from typing import List, Optional, Union
+
+# Версионированный протокол WebSocket. Каждый кадр - конверт {"v": 1, "type": ..., ...}.
+# Клиент выбирает кодировку через Sec-WebSocket-Protocol: msgpack в бинарных кадрах или JSON в текстовых.
+# Клиенты без подпротокола получают JSON и могут по-прежнему присылать сообщения простым текстом
+PROTOCOL_VERSION = 1
+MSGPACK_SUBPROTOCOL = "chat.v1.msgpack"
+JSON_SUBPROTOCOL = "chat.v1.json"
+# Браузер не может передать заголовок Authorization при открытии сокета, поэтому токен
+# передается дополнительным подпротоколом "access_token.<jwt>"
+AUTH_SUBPROTOCOL_PREFIX = "access_token."
+
+# Сервер -> клиент
+FRAME_MESSAGE = "message"            # {chat_id, seq, message}
+FRAME_NOTIFICATION = "notification"  # {text}
+FRAME_PRESENCE = "presence"          # {users: [{user_id, username?, online}, ...]} - изменения за интервал
+FRAME_ACK = "ack"                    # {ref, id, seq} - сообщение клиента сохранено и разослано
+FRAME_RESYNC = "resync"              # {chat_id, seq} - пропуск не восполнить из буфера, нужен запрос истории через REST
+FRAME_PONG = "pong"
+FRAME_ERROR = "error"                # {detail}
+# Клиент -> сервер
+FRAME_PING = "ping"                  # {} ; FRAME_MESSAGE: {content, ref?}
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class Frame:
+    # Кадр кодируется не более одного раза на каждую кодировку, сколько бы сокетов его ни получили
+    __slots__ = ("type", "payload", "seq", "_text", "_binary")
+
+    def __init__(self, frame_type: str, payload: Optional[dict] = None, seq: Optional[int] = None):
+        self.type = frame_type
+        self.payload = payload or {}
+        self.seq = seq
+        self._text = None
+        self._binary = None
+
+    def envelope(self) -> dict:
+        envelope = {"v": PROTOCOL_VERSION, "type": self.type}
+        if self.seq is not None:
+            envelope["seq"] = self.seq
+        envelope.update(self.payload)
+        return envelope
+
+    def text(self) -> str:
+        if self._text is None:
+            self._text = json.dumps(self.envelope(), ensure_ascii=False)
+        return self._text
+
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = msgpack.packb(self.envelope())
+        return self._binary
+
+
+def choose_subprotocol(offered: List[str]) -> Optional[str]:
+    for subprotocol in (MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL):
+        if subprotocol in offered:
+            return subprotocol
+    return None
+
+
+def websocket_token(offered: List[str]) -> Optional[str]:
+    # Токен доступа в списке подпротоколов; сервер его не выбирает и обратно не отправляет
+    for subprotocol in offered:
+        if subprotocol.startswith(AUTH_SUBPROTOCOL_PREFIX):
+            return subprotocol[len(AUTH_SUBPROTOCOL_PREFIX):]
+    return None
+
+
+def decode_client_frame(data: Union[str, bytes]) -> dict:
+    if isinstance(data, bytes):
+        try:
+            frame = msgpack.unpackb(data)
+        except Exception as e:
+            raise ProtocolError(f"Malformed binary frame: {e}")
+    else:
+        try:
+            frame = json.loads(data)
+        except ValueError:
+            frame = None
+        if not isinstance(frame, dict) or "type" not in frame:
+            # Старые клиенты присылают текст сообщения без конверта
+            return {"type": FRAME_MESSAGE, "content": data}
+
+    if not isinstance(frame, dict) or not isinstance(frame.get("type"), str):
+        raise ProtocolError("Frame must be a map with a 'type' field")
+    if frame.get("v", PROTOCOL_VERSION) != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {frame.get('v')}")
+    return frame
@@ -0,0 +1,100 @@
+import logging
+import math
+import os
+import time
+from typing import List, Tuple
+from lru import TTLCache
+from metrics import RATE_LIMITED
+from redis_client import take_rate_limit_tokens
+
+logger = logging.getLogger(__name__)
+
+# Ограничение частоты отправки сообщений и кадров WebSocket. Общий лимит - token bucket в Redis (один вызов
+# Lua на проверку всех корзин), перед ним - такая же корзина в процессе: узел расходует не больше, чем все
+# узлы вместе, поэтому пустая локальная корзина означает пустую общую и отказ обходится без Redis.
+# Если Redis недоступен, действуют только локальные корзины.
+# Лимиты задаются как "количество/секунды" (емкость корзины и период ее полного пополнения), 0 - выключен
+RATE_LIMIT_LOCAL_SIZE = int(os.getenv("RATE_LIMIT_LOCAL_SIZE", "100000"))
+
+
+class RateLimit:
+    def __init__(self, name: str, scope: str, spec: str):
+        self.name = name
+        self.scope = scope
+        count, _, period = spec.partition("/")
+        self.capacity = int(count)
+        self.rate = self.capacity / float(period or 1)
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def key(self, subject_id: int) -> str:
+        return f"ratelimit:{self.name}:{self.scope}:{subject_id}"
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, limit: RateLimit, retry_after: float):
+        super().__init__(f"Rate limit {limit.name} per {limit.scope} exceeded")
+        self.limit = limit
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_seconds(self) -> int:
+        return max(1, math.ceil(self.retry_after))
+
+
+# Сообщения (REST и WebSocket вместе): от одного пользователя и всего в один чат
+MESSAGES_PER_USER = RateLimit("messages", "user", os.getenv("RATE_LIMIT_MESSAGES_USER", "20/10"))
+MESSAGES_PER_CHAT = RateLimit("messages", "chat", os.getenv("RATE_LIMIT_MESSAGES_CHAT", "200/10"))
+# Все входящие кадры WebSocket пользователя, включая ping; превышение закрывает соединение
+WS_FRAMES_PER_USER = RateLimit("ws_frames", "user", os.getenv("RATE_LIMIT_WS_FRAMES_USER", "60/10"))
+
+# Локальные корзины: ключ -> (токены, время обновления). Запись живет, пока корзина не пополнится целиком
+_local_buckets = TTLCache(maxsize=RATE_LIMIT_LOCAL_SIZE, ttl=60)
+
+
+async def limit_message(user_id: int, chat_id: int):
+    await _take([(MESSAGES_PER_USER, user_id), (MESSAGES_PER_CHAT, chat_id)])
+
+async def limit_ws_frame(user_id: int):
+    await _take([(WS_FRAMES_PER_USER, user_id)])
+
+async def _take(checks: List[Tuple[RateLimit, int]]):
+    # Бросает RateLimitExceeded, если хотя бы в одной корзине нет токена; иначе списывает по токену из каждой
+    buckets = [(limit, limit.key(subject_id)) for limit, subject_id in checks if limit.enabled]
+    if not buckets:
+        return
+    now = time.monotonic()
+    local = [_refill(limit, key, now) for limit, key in buckets]
+    for (limit, _), tokens in zip(buckets, local):
+        if tokens < 1:
+            RATE_LIMITED.labels(limit.name, limit.scope, "local").inc()
+            raise RateLimitExceeded(limit, (1 - tokens) / limit.rate)
+
+    try:
+        waits = await take_rate_limit_tokens([(key, limit.capacity, limit.rate) for limit, key in buckets])
+    except Exception as e:
+        logger.warning(f"Rate limiter unavailable, applying local limits only: {e}")
+        waits = None
+    if waits is not None:
+        # Переносим состояние общей корзины в локальную, чтобы следующие запросы отклонялись без Redis
+        for (limit, key), wait in zip(buckets, waits):
+            if wait > 0:
+                _store(limit, key, 1 - wait * limit.rate, now)
+        limit, wait = max(zip((limit for limit, _ in buckets), waits), key=lambda item: item[1])
+        RATE_LIMITED.labels(limit.name, limit.scope, "redis").inc()
+        raise RateLimitExceeded(limit, wait)
+
+    for (limit, key), tokens in zip(buckets, local):
+        _store(limit, key, tokens - 1, now)
+
+def _refill(limit: RateLimit, key: str, now: float) -> float:
+    state = _local_buckets.get(key)
+    if state is None:
+        return float(limit.capacity)
+    tokens, updated = state
+    return min(float(limit.capacity), tokens + (now - updated) * limit.rate)
+
+def _store(limit: RateLimit, key: str, tokens: float, now: float):
+    _local_buckets.set(key, (tokens, now), ttl=(limit.capacity - tokens) / limit.rate + 1)
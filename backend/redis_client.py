@@ -1,32 +1,503 @@
-import redis
+import redis.asyncio as aioredis
+from redis.asyncio.client import Pipeline
 import json
 import os
+import socket
+import time
+import uuid
+from metrics import REDIS_COMMAND_TIME
 
-redis_client = redis.from_url(os.getenv("REDIS_URL", "redis://redis:6379"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379")
 
-def add_online_user(user_id: int, username: str):
-    redis_client.sadd("online_users", user_id)
-    redis_client.set(f"user:{user_id}", username)
 
-def remove_online_user(user_id: int):
-    redis_client.srem("online_users", user_id)
-    redis_client.delete(f"user:{user_id}")
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        start_time = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            _command_time("MULTI" if self.is_transaction else "PIPELINE").observe(time.perf_counter() - start_time)
 
-def get_online_users():
-    user_ids = redis_client.smembers("online_users")
-    users = []
-    for uid in user_ids:
-        username = redis_client.get(f"user:{uid}")
-        users.append({"id": int(uid), "username": username})
-    return users
 
-def cache_message(chat_id: str, message_data: dict):
-    redis_client.lpush(f"chat:{chat_id}", json.dumps(message_data))
-    redis_client.ltrim(f"chat:{chat_id}", 0, 99)
+class InstrumentedRedis(aioredis.Redis):
+    # Клиент, замеряющий задержку каждой команды и пайплайна (Lua-скрипты видны как EVALSHA)
+    async def execute_command(self, *args, **options):
+        start_time = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            _command_time(args[0]).observe(time.perf_counter() - start_time)
 
-def get_cached_messages(chat_id: str):
-    messages = redis_client.lrange(f"chat:{chat_id}", 0, -1)
-    return [json.loads(msg) for msg in messages]
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
 
-def publish_notification(user_id: int, notification: str):
-    redis_client.publish(f"notifications:{user_id}", notification)
\ No newline at end of file
+
+_command_timers = {}
+
+def _command_time(command):
+    timer = _command_timers.get(command)
+    if timer is None:
+        timer = _command_timers[command] = REDIS_COMMAND_TIME.labels(str(command).upper())
+    return timer
+
+
+# Асинхронный клиент: все обращения к Redis идут из event loop
+redis_client = InstrumentedRedis.from_url(REDIS_URL)
+
+CHAT_CHANNEL_PREFIX = "chat_events:"
+NOTIFICATION_CHANNEL_PREFIX = "notifications:"
+# Канал, по которому узлы сбрасывают локальный кэш токенов пользователя
+AUTH_INVALIDATE_CHANNEL = "auth_invalidate"
+AUTH_USER_PREFIX = "auth:user:"
+
+# Членство в чатах: множества members:user:{id} (чаты пользователя) и members:chat:{id} (участники чата).
+# Служебный элемент 0 отличает собранное пустое множество от отсутствующего ключа. Новые участники
+# дописываются только в уже собранные множества, поэтому существующее множество всегда полное.
+# Каждое добавление увеличивает счетчик {множество}:version: снимок из базы записывается, только если
+# множества еще нет и версия не менялась с момента, когда ее прочитали перед запросом к базе
+MEMBERS_USER_PREFIX = "members:user:"
+MEMBERS_CHAT_PREFIX = "members:chat:"
+MEMBERSHIP_TTL = int(os.getenv("MEMBERSHIP_TTL", "600"))
+# Канал, по которому узлы сбрасывают локальный кэш членства
+MEMBERSHIP_CHANNEL = "membership_changed"
+
+# Присутствие: zset presence (user_id -> время последнего heartbeat), хэш online_users (user_id -> username)
+# и для каждого пользователя хэш presence:sessions:{user_id} с узлами, где у него открыт сокет.
+# Узел продлевает ключ presence:node:{node_id}; если узел упал, его пользователи уходят в offline по TTL
+ONLINE_USERS_KEY = "online_users"
+PRESENCE_KEY = "presence"
+PRESENCE_CHANNEL = "presence_events"
+PRESENCE_SESSIONS_PREFIX = "presence:sessions:"
+PRESENCE_NODE_PREFIX = "presence:node:"
+PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", "45"))
+# Уникальный id процесса: у каждого воркера свои сокеты
+NODE_ID = os.getenv("NODE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+# KEYS: presence, online_users, presence:node:{node}, presence:sessions:{uid}...
+# ARGV: now, node_id, ttl, channel, затем тройки uid, username, событие
+_presence_online_script = redis_client.register_script("""
+redis.call('SET', KEYS[3], 1, 'EX', ARGV[3])
+for i = 5, #ARGV, 3 do
+    local uid = ARGV[i]
+    redis.call('HSET', KEYS[4 + (i - 5) / 3], ARGV[2], 1)
+    if redis.call('ZADD', KEYS[1], ARGV[1], uid) == 1 then
+        redis.call('HSET', KEYS[2], uid, ARGV[i + 1])
+        redis.call('PUBLISH', ARGV[4], ARGV[i + 2])
+    end
+end
+""")
+
+# KEYS: presence, online_users, presence:sessions:{uid}; ARGV: node_id, uid, channel
+_presence_offline_script = redis_client.register_script("""
+redis.call('HDEL', KEYS[3], ARGV[1])
+if redis.call('HLEN', KEYS[3]) == 0 and redis.call('ZREM', KEYS[1], ARGV[2]) == 1 then
+    redis.call('HDEL', KEYS[2], ARGV[2])
+    redis.call('PUBLISH', ARGV[3], '{"type": "presence", "user_id": ' .. ARGV[2] .. ', "online": false}')
+end
+""")
+
+# Снимает пользователей, которых давно не подтверждал ни один живой узел.
+# KEYS: presence, online_users; ARGV: cutoff, channel, префикс ключа узла, префикс хэша сессий
+_presence_sweep_script = redis_client.register_script("""
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 1000)
+for _, uid in ipairs(expired) do
+    local sessions = ARGV[4] .. uid
+    for _, node in ipairs(redis.call('HKEYS', sessions)) do
+        if redis.call('EXISTS', ARGV[3] .. node) == 0 then
+            redis.call('HDEL', sessions, node)
+        end
+    end
+    if redis.call('HLEN', sessions) == 0 then
+        redis.call('ZREM', KEYS[1], uid)
+        redis.call('HDEL', KEYS[2], uid)
+        redis.call('PUBLISH', ARGV[2], '{"type": "presence", "user_id": ' .. uid .. ', "online": false}')
+    end
+end
+return #expired
+""")
+
+async def mark_users_online(users: dict):
+    # users: user_id -> username для всех пользователей с сокетами на этом узле (heartbeat)
+    keys = [PRESENCE_KEY, ONLINE_USERS_KEY, f"{PRESENCE_NODE_PREFIX}{NODE_ID}"]
+    args = [time.time(), NODE_ID, PRESENCE_TTL, PRESENCE_CHANNEL]
+    for user_id, username in users.items():
+        keys.append(f"{PRESENCE_SESSIONS_PREFIX}{user_id}")
+        event = {"type": "presence", "user_id": user_id, "username": username, "online": True}
+        args.extend([user_id, username, json.dumps(event)])
+    await _presence_online_script(keys=keys, args=args, client=redis_client)
+
+async def add_online_user(user_id: int, username: str):
+    await mark_users_online({user_id: username})
+
+async def remove_online_user(user_id: int):
+    await _presence_offline_script(
+        keys=[PRESENCE_KEY, ONLINE_USERS_KEY, f"{PRESENCE_SESSIONS_PREFIX}{user_id}"],
+        args=[NODE_ID, user_id, PRESENCE_CHANNEL],
+        client=redis_client
+    )
+
+async def expire_offline_users():
+    await _presence_sweep_script(
+        keys=[PRESENCE_KEY, ONLINE_USERS_KEY],
+        args=[time.time() - PRESENCE_TTL, PRESENCE_CHANNEL, PRESENCE_NODE_PREFIX, PRESENCE_SESSIONS_PREFIX],
+        client=redis_client
+    )
+
+async def get_online_users():
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zrangebyscore(PRESENCE_KEY, time.time() - PRESENCE_TTL, "+inf")
+    pipe.hgetall(ONLINE_USERS_KEY)
+    user_ids, usernames = await pipe.execute()
+    return [{"id": int(uid), "username": usernames.get(uid, b"").decode()} for uid in user_ids]
+
+# Сколько последних сообщений чата хранится в Redis и как долго кэш считается актуальным
+RECENT_MESSAGES_LIMIT = 100
+RECENT_MESSAGES_TTL = int(os.getenv("RECENT_MESSAGES_TTL", "3600"))
+# Сколько живет маркер незавершенного прогрева (прогревающий узел мог упасть между чтением базы и записью)
+RECENT_WARMUP_TTL = int(os.getenv("RECENT_WARMUP_TTL", "30"))
+
+# Сводка для списка чатов: хэши chat_last_message_id и chat_last_message (chat_id -> id и JSON последнего
+# сообщения; у пустого чата 0 и "") и у каждого пользователя хэш unread:{user_id} (chat_id -> непрочитанные).
+# Источник истины - chat_members.last_read_message_id в Postgres: хэш unread пересобирается из базы целиком,
+# а до этого не трогается, поэтому существующий хэш всегда полный (отсутствующее поле = 0)
+CHAT_LAST_MESSAGE_ID_KEY = "chat_last_message_id"
+CHAT_LAST_MESSAGE_KEY = "chat_last_message"
+UNREAD_PREFIX = "unread:"
+# Периодическая пересборка из базы исправляет возможный дрейф счетчиков
+UNREAD_TTL = int(os.getenv("UNREAD_TTL", "86400"))
+
+# Список chat:{id} хранит последние сообщения (новые в начале). Он читается только при наличии
+# маркера chat:{id}:ready, который ставится при прогреве из Postgres: без маркера список может быть неполным.
+# Пока идет прогрев, во множестве chat:{id}:warming лежат токены прогревающих: новые сообщения дописываются
+# в список и в это время, а прогрев сливает свой снимок из базы со списком, а не заменяет его.
+# Тот же скрипт обновляет последнее сообщение чата и счетчики непрочитанного получателей.
+# KEYS: chat:{id}, chat:{id}:ready, chat:{id}:warming, chat_last_message_id, chat_last_message,
+# затем unread:{получатель}...
+# ARGV: JSON сообщения, размер списка, chat_id, id сообщения
+_record_message_script = redis_client.register_script("""
+if redis.call('EXISTS', KEYS[2]) == 1 or redis.call('EXISTS', KEYS[3]) == 1 then
+    redis.call('LPUSH', KEYS[1], ARGV[1])
+    redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+end
+if tonumber(ARGV[4]) > tonumber(redis.call('HGET', KEYS[4], ARGV[3]) or '0') then
+    redis.call('HSET', KEYS[4], ARGV[3], ARGV[4])
+    redis.call('HSET', KEYS[5], ARGV[3], ARGV[1])
+end
+for i = 6, #KEYS do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('HINCRBY', KEYS[i], ARGV[3], 1)
+    end
+end
+""")
+
+# Выставляет счетчик, только если хэш пользователя уже собран. KEYS: unread:{user_id}; ARGV: chat_id, count
+_set_unread_script = redis_client.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+""")
+
+# Сливает снимок последних сообщений из базы с тем, что record_message дописал во время прогрева:
+# объединение по id, новые в начале, не больше размера списка. Если токен прогрева исчез (кэш сброшен
+# invalidate_message_cache), снимок мог устареть и не записывается.
+# KEYS: chat:{id}, chat:{id}:ready, chat:{id}:warming; ARGV: токен, размер списка, TTL, затем пары id, JSON
+_warm_messages_script = redis_client.register_script("""
+if redis.call('SISMEMBER', KEYS[3], ARGV[1]) == 0 then
+    return 0
+end
+local entries = {}
+local seen = {}
+for _, item in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    local id = cjson.decode(item).id
+    if not seen[id] then
+        seen[id] = true
+        table.insert(entries, {id, item})
+    end
+end
+for i = 4, #ARGV, 2 do
+    local id = tonumber(ARGV[i])
+    if not seen[id] then
+        seen[id] = true
+        table.insert(entries, {id, ARGV[i + 1]})
+    end
+end
+table.sort(entries, function(a, b) return a[1] > b[1] end)
+redis.call('DEL', KEYS[1])
+for i = 1, math.min(#entries, tonumber(ARGV[2])) do
+    redis.call('RPUSH', KEYS[1], entries[i][2])
+end
+if #entries > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[3])
+redis.call('SREM', KEYS[3], ARGV[1])
+return 1
+""")
+
+# Добавляет элементы в каждое из уже существующих множеств и увеличивает версии всех множеств.
+# KEYS: множества, затем их версии; ARGV: TTL версии, элементы
+_add_to_sets_script = redis_client.register_script("""
+local count = #KEYS / 2
+for i = 1, count do
+    redis.call('INCR', KEYS[count + i])
+    redis.call('EXPIRE', KEYS[count + i], ARGV[1])
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('SADD', KEYS[i], unpack(ARGV, 2))
+    end
+end
+""")
+
+# Записывает множество, загруженное из базы. KEYS: множество, его версия; ARGV: версия, прочитанная
+# до запроса к базе, TTL, элементы. Возвращает 0, если множество уже есть или снимок мог устареть
+_cache_id_set_script = redis_client.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 1 or (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('SADD', KEYS[1], 0)
+for i = 3, #ARGV, 1000 do
+    redis.call('SADD', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+def _recent_key(chat_id: int) -> str:
+    return f"chat:{chat_id}"
+
+def _recent_ready_key(chat_id: int) -> str:
+    return f"chat:{chat_id}:ready"
+
+def _recent_warming_key(chat_id: int) -> str:
+    return f"chat:{chat_id}:warming"
+
+async def record_message(chat_id: int, message_data: dict, recipient_ids):
+    # Write-through: дописываем сообщение только в уже прогретый кэш, обновляем сводку чата
+    # и непрочитанное получателей (без автора) за один вызов
+    await _record_message_script(
+        keys=[_recent_key(chat_id), _recent_ready_key(chat_id), _recent_warming_key(chat_id), CHAT_LAST_MESSAGE_ID_KEY,
+              CHAT_LAST_MESSAGE_KEY, *(f"{UNREAD_PREFIX}{user_id}" for user_id in recipient_ids)],
+        args=[json.dumps(message_data), RECENT_MESSAGES_LIMIT, chat_id, message_data["id"]],
+        client=redis_client
+    )
+
+async def get_cached_messages(chat_id: int, limit: int = RECENT_MESSAGES_LIMIT):
+    # Возвращает последние limit сообщений в хронологическом порядке или None, если кэш не прогрет
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.exists(_recent_ready_key(chat_id))
+    pipe.lrange(_recent_key(chat_id), 0, limit - 1)
+    ready, messages = await pipe.execute()
+    if not ready:
+        return None
+    return sorted((json.loads(msg) for msg in messages), key=lambda m: m["id"])
+
+async def begin_message_cache_warmup(chat_id: int) -> str:
+    # Вызывается до чтения из базы: с этого момента record_message дописывает новые сообщения в список
+    token = uuid.uuid4().hex
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.sadd(_recent_warming_key(chat_id), token)
+    pipe.expire(_recent_warming_key(chat_id), RECENT_WARMUP_TTL)
+    await pipe.execute()
+    return token
+
+async def warm_message_cache(chat_id: int, token: str, messages: list):
+    # messages - последние сообщения чата из базы, прочитанные после begin_message_cache_warmup
+    args = [token, RECENT_MESSAGES_LIMIT, RECENT_MESSAGES_TTL]
+    for message in messages[-RECENT_MESSAGES_LIMIT:]:
+        args.extend((message["id"], json.dumps(message)))
+    await _warm_messages_script(
+        keys=[_recent_key(chat_id), _recent_ready_key(chat_id), _recent_warming_key(chat_id)], args=args,
+        client=redis_client
+    )
+
+async def invalidate_message_cache(chat_id: int):
+    await redis_client.delete(_recent_ready_key(chat_id), _recent_key(chat_id), _recent_warming_key(chat_id))
+
+async def get_chat_summaries(user_id: int, chat_ids):
+    # Возвращает (последние сообщения, непрочитанное). В первом словаре нет чатов, о которых Redis не знает;
+    # у пустых чатов значение None. Второй словарь None, если хэш пользователя не собран
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hmget(CHAT_LAST_MESSAGE_KEY, chat_ids)
+    pipe.hgetall(f"{UNREAD_PREFIX}{user_id}")
+    last_messages, unread = await pipe.execute()
+    summaries = {
+        chat_id: json.loads(message) if message else None
+        for chat_id, message in zip(chat_ids, last_messages) if message is not None
+    }
+    if not unread:
+        return summaries, None
+    return summaries, {int(chat_id): int(count) for chat_id, count in unread.items()}
+
+async def warm_chat_summaries(last_messages: dict, user_id: int = None, unread: dict = None):
+    # last_messages: chat_id -> сообщение или None для пустого чата. HSETNX не затирает сообщение,
+    # записанное record_message, пока данные читались из базы
+    pipe = redis_client.pipeline(transaction=True)
+    for chat_id, message in last_messages.items():
+        pipe.hsetnx(CHAT_LAST_MESSAGE_ID_KEY, chat_id, message["id"] if message else 0)
+        pipe.hsetnx(CHAT_LAST_MESSAGE_KEY, chat_id, json.dumps(message) if message else "")
+    if unread is not None:
+        key = f"{UNREAD_PREFIX}{user_id}"
+        pipe.delete(key)
+        # Служебное поле 0 держит хэш существующим, даже если у пользователя нет чатов
+        pipe.hset(key, mapping={0: 0, **unread})
+        pipe.expire(key, UNREAD_TTL)
+    if len(pipe):
+        await pipe.execute()
+
+async def set_unread_count(user_id: int, chat_id: int, count: int):
+    await _set_unread_script(keys=[f"{UNREAD_PREFIX}{user_id}"], args=[chat_id, count], client=redis_client)
+
+async def publish_notification(user_id: int, notification: str):
+    await redis_client.publish(f"{NOTIFICATION_CHANNEL_PREFIX}{user_id}", notification)
+
+async def publish_notifications(user_ids, notification: str):
+    # Уведомление всем адресатам за один round-trip
+    pipe = redis_client.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.publish(f"{NOTIFICATION_CHANNEL_PREFIX}{user_id}", notification)
+    if len(pipe):
+        await pipe.execute()
+
+# События чата нумеруются счетчиком chat:{id}:seq. Последние CHAT_REPLAY_SIZE событий хранятся в
+# chat:{id}:replay, чтобы переподключившийся клиент мог дополучить пропущенное с нужного seq.
+# В канал и буфер событие попадает в виде "seq:payload"
+CHAT_REPLAY_SIZE = int(os.getenv("CHAT_REPLAY_SIZE", "500"))
+CHAT_REPLAY_TTL = int(os.getenv("CHAT_REPLAY_TTL", "86400"))
+
+_publish_chat_event_script = redis_client.register_script("""
+local seq = redis.call('INCR', KEYS[1])
+local event = seq .. ':' .. ARGV[1]
+redis.call('ZADD', KEYS[2], seq, event)
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('PUBLISH', ARGV[4], event)
+return seq
+""")
+
+async def publish_chat_event(chat_id: int, payload: str) -> int:
+    return await _publish_chat_event_script(
+        keys=[f"chat:{chat_id}:seq", f"chat:{chat_id}:replay"],
+        args=[payload, CHAT_REPLAY_SIZE, CHAT_REPLAY_TTL, f"{CHAT_CHANNEL_PREFIX}{chat_id}"],
+        client=redis_client
+    )
+
+async def get_chat_events_since(chat_id: int, seq: int):
+    # Возвращает текущий seq чата и сохраненные события с номером больше seq
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.get(f"chat:{chat_id}:seq")
+    pipe.zrangebyscore(f"chat:{chat_id}:replay", f"({seq}", "+inf")
+    current, events = await pipe.execute()
+    return int(current or 0), [split_chat_event(event.decode()) for event in events]
+
+def split_chat_event(event: str):
+    seq, _, payload = event.partition(":")
+    return int(seq), payload
+
+
+async def get_cached_principal(username: str):
+    data = await redis_client.get(f"{AUTH_USER_PREFIX}{username}")
+    return json.loads(data) if data is not None else None
+
+async def cache_principal(username: str, principal: dict, ttl: int):
+    await redis_client.set(f"{AUTH_USER_PREFIX}{username}", json.dumps(principal), ex=ttl)
+
+async def invalidate_principal(username: str):
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.delete(f"{AUTH_USER_PREFIX}{username}")
+    pipe.publish(AUTH_INVALIDATE_CHANNEL, username)
+    await pipe.execute()
+
+async def get_cached_chat_ids(user_id: int):
+    return await _get_id_set(f"{MEMBERS_USER_PREFIX}{user_id}")
+
+async def get_cached_member_ids(chat_id: int):
+    return await _get_id_set(f"{MEMBERS_CHAT_PREFIX}{chat_id}")
+
+async def cache_chat_ids(user_id: int, version: str, chat_ids):
+    await _set_id_set(f"{MEMBERS_USER_PREFIX}{user_id}", version, chat_ids)
+
+async def cache_member_ids(chat_id: int, version: str, user_ids):
+    await _set_id_set(f"{MEMBERS_CHAT_PREFIX}{chat_id}", version, user_ids)
+
+async def add_memberships(chat_id: int, user_ids, new_chat: bool = False):
+    # Новые участники: у нового чата множество участников известно целиком, у существующего дописываем
+    # в собранное множество. Другие узлы сбрасывают свой локальный кэш по событию
+    chat_key = f"{MEMBERS_CHAT_PREFIX}{chat_id}"
+    user_keys = [f"{MEMBERS_USER_PREFIX}{user_id}" for user_id in user_ids]
+    pipe = redis_client.pipeline(transaction=True)
+    if new_chat:
+        pipe.sadd(chat_key, 0, *user_ids)
+        pipe.expire(chat_key, MEMBERSHIP_TTL)
+        pipe.incr(_version_key(chat_key))
+        pipe.expire(_version_key(chat_key), MEMBERSHIP_TTL)
+    else:
+        await _add_to_sets_script(keys=[chat_key, _version_key(chat_key)], args=[MEMBERSHIP_TTL, *user_ids],
+                                  client=pipe)
+    await _add_to_sets_script(keys=[*user_keys, *(_version_key(key) for key in user_keys)],
+                              args=[MEMBERSHIP_TTL, chat_id], client=pipe)
+    pipe.publish(MEMBERSHIP_CHANNEL, json.dumps({"chat_id": chat_id, "user_ids": list(user_ids)}))
+    await pipe.execute()
+
+def _version_key(key: str) -> str:
+    return f"{key}:version"
+
+async def _get_id_set(key: str):
+    # Возвращает (множество или None, версия). Версию при промахе передают в _set_id_set после чтения базы
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.smembers(key)
+    pipe.get(_version_key(key))
+    members, version = await pipe.execute()
+    version = version.decode() if version is not None else ""
+    if not members:
+        return None, version
+    return {int(member) for member in members} - {0}, version
+
+async def _set_id_set(key: str, version: str, ids):
+    await _cache_id_set_script(keys=[key, _version_key(key)], args=[version, MEMBERSHIP_TTL, *ids],
+                               client=redis_client)
+
+# Token bucket для ограничения частоты: хэш ratelimit:{лимит}:{scope}:{id} с полями tokens и ts.
+# Все корзины проверяются атомарно и списываются, только если токены есть в каждой; время - часы Redis,
+# общие для всех узлов. KEYS: корзины; ARGV: для каждой корзины емкость и скорость пополнения (токенов в секунду).
+# Возвращает пустой список, если запрос пропущен, иначе для каждой корзины время ожидания в секундах
+_take_tokens_script = redis_client.register_script("""
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local available = {}
+local waits = {}
+local denied = false
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local rate = tonumber(ARGV[i * 2])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    available[i] = tokens
+    if tokens < 1 then
+        denied = true
+        waits[i] = tostring((1 - tokens) / rate)
+    else
+        waits[i] = '0'
+    end
+end
+if denied then
+    return waits
+end
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local rate = tonumber(ARGV[i * 2])
+    redis.call('HSET', KEYS[i], 'tokens', tostring(available[i] - 1), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[i], math.ceil(capacity / rate) + 1)
+end
+return {}
+""")
+
+async def take_rate_limit_tokens(buckets):
+    # buckets: [(ключ, емкость, токенов в секунду)]. None - пропущено, иначе ожидание по каждой корзине
+    args = []
+    for _, capacity, rate in buckets:
+        args.extend((capacity, rate))
+    waits = await _take_tokens_script(keys=[key for key, _, _ in buckets], args=args, client=redis_client)
+    if not waits:
+        return None
+    return [float(wait) for wait in waits]
@@ -20,32 +20,72 @@ class User(BaseModel):
     class Config:
         from_attributes = True
 
+class CurrentUser(BaseModel):
+    id: int
+    username: str
+    is_active: bool = True
+
+    class Config:
+        from_attributes = True
+
 class ChatCreate(BaseModel):
     name: str
     is_group: bool = False
     members: List[int]
 
+class MessageCreate(BaseModel):
+    content: str
+    chat_id: int
+
+class Message(BaseModel):
+    id: int
+    content: str
+    timestamp: datetime
+    user_id: int
+    chat_id: int
+    user: User
+
+    class Config:
+        from_attributes = True
+
 class Chat(BaseModel):
     id: int
     name: str
     is_group: bool
     created_at: datetime
     members: List[User]
+    last_message: Optional[Message] = None
+    last_read_message_id: Optional[int] = None
+    unread_count: int = 0
 
     class Config:
         from_attributes = True
 
-class MessageCreate(BaseModel):
-    content: str
+class MarkRead(BaseModel):
+    # Без message_id чат отмечается прочитанным до последнего сообщения
+    message_id: Optional[int] = None
+
+class ReadState(BaseModel):
     chat_id: int
+    last_read_message_id: Optional[int] = None
+    unread_count: int
 
-class Message(BaseModel):
-    id: int
-    content: str
-    timestamp: datetime
+class MessagePage(BaseModel):
+    messages: List[Message]
+    next_cursor: Optional[int] = None
+
+class SearchPage(BaseModel):
+    # Результаты по убыванию релевантности; next_cursor передается в следующий запрос как cursor
+    messages: List[Message]
+    next_cursor: Optional[str] = None
+
+class RegisterResponse(BaseModel):
+    message: str
     user_id: int
-    chat_id: int
-    user: User
 
-    class Config:
-        from_attributes = True
\ No newline at end of file
+class Token(BaseModel):
+    access_token: str
+    token_type: str
+
+class StatusMessage(BaseModel):
+    message: str
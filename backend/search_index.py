@@ -0,0 +1,100 @@
+import argparse
+import hashlib
+import hmac
+import logging
+import os
+import re
+from collections import Counter
+from typing import List
+
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.pool import NullPool
+
+from database import DATABASE_URL
+from encryption import ENCRYPTION_KEY, decrypt_message
+from models import Message, message_search_tokens
+
+logger = logging.getLogger(__name__)
+
+# Слепой индекс для поиска по зашифрованным сообщениям: вместо слов хранится HMAC от (chat_id, слово),
+# усеченный до 64 бит. Без ключа по индексу не восстановить текст, а одно и то же слово в разных чатах
+# дает разные хэши. Смена ключа требует перестроения индекса (очистить таблицу и запустить этот модуль)
+SEARCH_INDEX_KEY = os.getenv("SEARCH_INDEX_KEY")
+_index_key = (
+    SEARCH_INDEX_KEY.encode() if SEARCH_INDEX_KEY
+    else hmac.new(ENCRYPTION_KEY.encode(), b"message-search-index", hashlib.sha256).digest()
+)
+SEARCH_MIN_TOKEN_LENGTH = int(os.getenv("SEARCH_MIN_TOKEN_LENGTH", "2"))
+SEARCH_MAX_TOKEN_LENGTH = 64
+SEARCH_MAX_QUERY_TERMS = int(os.getenv("SEARCH_MAX_QUERY_TERMS", "16"))
+SEARCH_BACKFILL_BATCH = int(os.getenv("SEARCH_BACKFILL_BATCH", "1000"))
+# Вес слова - число вхождений в сообщение (SmallInteger в базе)
+MAX_TOKEN_WEIGHT = 32767
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> Counter:
+    return Counter(
+        token for token in _TOKEN_RE.findall(text.casefold())
+        if SEARCH_MIN_TOKEN_LENGTH <= len(token) <= SEARCH_MAX_TOKEN_LENGTH
+    )
+
+def token_hash(chat_id: int, token: str) -> int:
+    digest = hmac.new(_index_key, f"{chat_id}:{token}".encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+def index_rows(chat_id: int, message_id: int, text: str) -> List[dict]:
+    return [
+        {"chat_id": chat_id, "token_hash": token_hash(chat_id, token), "message_id": message_id,
+         "weight": min(count, MAX_TOKEN_WEIGHT)}
+        for token, count in tokenize(text).items()
+    ]
+
+def query_hashes(chat_id: int, query: str) -> List[int]:
+    return [token_hash(chat_id, token) for token in list(tokenize(query))[:SEARCH_MAX_QUERY_TERMS]]
+
+
+def backfill(conn, start_id: int = 0, batch_size: int = SEARCH_BACKFILL_BATCH) -> int:
+    # Индексирует сообщения, записанные до появления индекса. Новые сообщения индексирует message_writer
+    # в той же транзакции, поэтому уже проиндексированные пропускаются и повторный запуск безопасен.
+    # conn - синхронное соединение или Session
+    indexed = 0
+    last_id = start_id
+    while True:
+        rows = conn.execute(
+            select(Message.id, Message.chat_id, Message.content)
+            .where(Message.id > last_id).order_by(Message.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        ids = [row.id for row in rows]
+        done = set(conn.execute(
+            select(message_search_tokens.c.message_id).where(message_search_tokens.c.message_id.in_(ids)).distinct()
+        ).scalars())
+        pending = [row for row in rows if row.id not in done]
+        entries = [entry for row in pending for entry in index_rows(row.chat_id, row.id, decrypt_message(row.content))]
+        if entries:
+            conn.execute(insert(message_search_tokens), entries)
+        conn.commit()
+        indexed += len(pending)
+        last_id = ids[-1]
+        logger.info(f"Indexed messages up to id {last_id}")
+    return indexed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill the message search index")
+    parser.add_argument("--start-id", type=int, default=0, help="resume after this message id")
+    parser.add_argument("--batch-size", type=int, default=SEARCH_BACKFILL_BATCH)
+    args = parser.parse_args()
+
+    engine = create_engine(DATABASE_URL, poolclass=NullPool)
+    with engine.connect() as conn:
+        indexed = backfill(conn, args.start_id, args.batch_size)
+    engine.dispose()
+    logger.info(f"Search index backfill finished, {indexed} messages indexed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# Тесты запускают приложение in-process, как benchmarks/harness.py: временная SQLite со схемой из миграций
+# и fakeredis вместо Redis. Запуск из каталога backend: python -m pytest -q
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from collections import namedtuple
+from urllib.parse import urlencode
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# Временная база, ключи и снятые лимиты; main и остальные модули прочитают их в импортах ниже
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='messenger-test-'), 'test.sqlite')}"
+os.environ.setdefault("ENCRYPTION_KEY", "Xo_Q1qXG_dsMWHPHZJ1K_eUgUSIi3vFydSpUtOR1lyI=")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ["EXPOSE_QUERY_COUNT"] = "1"
+for name in ("RATE_LIMIT_MESSAGES_USER", "RATE_LIMIT_MESSAGES_CHAT", "RATE_LIMIT_WS_FRAMES_USER"):
+    os.environ[name] = "1000000/1"
+
+import fakeredis  # noqa: E402
+import redis_client  # noqa: E402
+
+redis_client.redis_client = fakeredis.aioredis.FakeRedis()
+
+import httpx  # noqa: E402
+import main  # noqa: E402
+import migrate  # noqa: E402
+from auth import create_access_token  # noqa: E402
+
+TEST_PASSWORD = "test-password"
+
+# users - (id, заголовки) всех участников, первым идет создатель; headers - заголовки создателя
+Chat = namedtuple("Chat", "id headers users")
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    # Один event loop на все тесты: движок базы, fakeredis и фоновые задачи приложения привязаны к нему
+    return "asyncio"
+
+
+@pytest.fixture(scope="session")
+async def app(anyio_backend):
+    migrate.main()
+    async with main.app.router.lifespan_context(main.app):
+        yield main.app
+
+
+@pytest.fixture
+async def client(app):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client
+
+
+@pytest.fixture
+def register(client):
+    # Регистрирует пользователя с уникальным именем и возвращает (id, заголовки с токеном).
+    # Токен выдается напрямую, как в harness: второй прогон bcrypt через /token только замедлил бы тесты
+    counter = iter(range(1, 1_000_000))
+
+    async def register(prefix: str = "user"):
+        username = f"{prefix}_{os.urandom(4).hex()}_{next(counter)}"
+        response = await client.post("/register/", json={"username": username, "password": TEST_PASSWORD})
+        assert response.status_code == 200, response.text
+        token = create_access_token(data={"sub": username})
+        return response.json()["user_id"], {"Authorization": f"Bearer {token}"}
+
+    return register
+
+
+@pytest.fixture
+def chat(client, register):
+    # Создает групповой чат с members новыми участниками и messages сообщениями,
+    # которые участники отправляют по очереди и параллельно (message_writer запишет их несколькими пачками)
+    async def chat(members: int = 0, messages: int = 0, name: str = "test"):
+        users = [await register() for _ in range(members + 1)]
+        headers = users[0][1]
+        response = await client.post("/chats/", json={"name": name, "is_group": True,
+                                                      "members": [user_id for user_id, _ in users[1:]]}, headers=headers)
+        assert response.status_code == 200, response.text
+        chat_id = response.json()["id"]
+        responses = await asyncio.gather(*(
+            client.post("/messages/", json={"content": f"message {i}", "chat_id": chat_id},
+                        headers=users[i % len(users)][1])
+            for i in range(messages)
+        ))
+        assert all(response.status_code == 200 for response in responses)
+        return Chat(chat_id, headers, users)
+
+    return chat
+
+
+class WebSocketClient:
+    # WebSocket-клиент поверх ASGI: httpx.ASGITransport умеет только HTTP, а TestClient запускает
+    # приложение в своем event loop, отдельно от движка базы и fakeredis тестов
+    def __init__(self, app, path: str, params: dict = None, subprotocols=()):
+        self.app = app
+        self.scope = {
+            "type": "websocket", "asgi": {"version": "3.0"}, "scheme": "ws", "http_version": "1.1",
+            "path": path, "raw_path": path.encode(), "root_path": "",
+            "query_string": urlencode(params or {}).encode(), "headers": [(b"host", b"test")],
+            "subprotocols": list(subprotocols), "client": ("testclient", 50000), "server": ("test", 80),
+        }
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.outgoing: asyncio.Queue = asyncio.Queue()
+        self.accepted = False
+        self.subprotocol = None
+        self.close_code = None
+
+    async def __aenter__(self):
+        await self.incoming.put({"type": "websocket.connect"})
+        self.task = asyncio.create_task(self.app(self.scope, self.incoming.get, self.outgoing.put))
+        message = await asyncio.wait_for(self.outgoing.get(), timeout=5)
+        if message["type"] == "websocket.accept":
+            self.accepted = True
+            self.subprotocol = message.get("subprotocol")
+        else:
+            self.close_code = message.get("code")
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.incoming.put({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(self.task, timeout=5)
+
+    async def send_json(self, data: dict):
+        await self.incoming.put({"type": "websocket.receive", "text": json.dumps(data)})
+
+    async def receive_json(self) -> dict:
+        message = await asyncio.wait_for(self.outgoing.get(), timeout=5)
+        assert message["type"] == "websocket.send", message
+        return json.loads(message["text"])
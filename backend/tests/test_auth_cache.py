@@ -0,0 +1,46 @@
+# Кэш проверенных токенов (auth.get_current_user) сбрасывается при смене is_active
+import asyncio
+
+import pytest
+
+from auth import set_active
+from crud import set_user_active
+from database import AsyncSessionLocal
+from redis_client import invalidate_principal
+
+pytestmark = pytest.mark.anyio
+
+
+async def wait_for_status(client, headers, expected: int):
+    for _ in range(50):
+        response = await client.get("/chats/", headers=headers)
+        if response.status_code == expected:
+            return
+        await asyncio.sleep(0.02)
+    assert response.status_code == expected
+
+
+async def test_deactivation_invalidates_cached_token(client, register):
+    user_id, headers = await register()
+    assert (await client.get("/chats/", headers=headers)).status_code == 200
+
+    async with AsyncSessionLocal() as db:
+        await set_active(db, user_id, False)
+    assert (await client.get("/chats/", headers=headers)).status_code == 401
+
+    async with AsyncSessionLocal() as db:
+        await set_active(db, user_id, True)
+    assert (await client.get("/chats/", headers=headers)).status_code == 200
+
+
+async def test_invalidation_from_another_node(client, register):
+    # Другой узел меняет базу и публикует сброс; локальный кэш этого узла сбрасывает подписчик Redis
+    user_id, headers = await register()
+    assert (await client.get("/chats/", headers=headers)).status_code == 200
+
+    async with AsyncSessionLocal() as db:
+        username = await set_user_active(db, user_id, False)
+    assert (await client.get("/chats/", headers=headers)).status_code == 200
+
+    await invalidate_principal(username)
+    await wait_for_status(client, headers, 401)
@@ -0,0 +1,60 @@
+# Кэш членства (membership.py) при добавлении участника во время загрузки из базы
+import pytest
+
+import membership
+import redis_client
+from database import AsyncSessionLocal
+
+pytestmark = pytest.mark.anyio
+
+
+def add_member_before(monkeypatch, client, name, key, chat_id, user_id, owner_headers):
+    # Участник добавляется после чтения снимка key из базы, но до записи снимка в Redis
+    cache = getattr(membership, name)
+    pending = [key]
+
+    async def add_then_cache(cache_key, *args):
+        if cache_key in pending:
+            pending.remove(cache_key)
+            response = await client.post(f"/chats/{chat_id}/add-user/{user_id}", headers=owner_headers)
+            assert response.status_code == 200, response.text
+        await cache(cache_key, *args)
+
+    monkeypatch.setattr(membership, name, add_then_cache)
+
+
+def forget_local():
+    membership._user_chats.clear()
+    membership._chat_members.clear()
+
+
+async def test_member_added_during_user_chats_load(client, chat, register, monkeypatch):
+    chat_id, owner_headers, _ = await chat()
+    user_id, user_headers = await register()
+    add_member_before(monkeypatch, client, "cache_chat_ids", user_id, chat_id, user_id, owner_headers)
+    async with AsyncSessionLocal() as db:
+        assert chat_id not in await membership.get_user_chat_ids(db, user_id)
+    monkeypatch.undo()
+
+    async with AsyncSessionLocal() as db:
+        assert await membership.is_chat_member(db, chat_id, user_id)
+        forget_local()
+        assert await membership.is_chat_member(db, chat_id, user_id)
+    assert (await client.get(f"/messages/{chat_id}", headers=user_headers)).status_code == 200
+
+
+async def test_member_added_during_chat_members_load(client, chat, register, monkeypatch):
+    chat_id, owner_headers, _ = await chat()
+    user_id, _ = await register()
+    # Множество участников нового чата записывается сразу при создании; нужна загрузка из базы
+    await redis_client.redis_client.delete(f"{redis_client.MEMBERS_CHAT_PREFIX}{chat_id}")
+    forget_local()
+    add_member_before(monkeypatch, client, "cache_member_ids", chat_id, chat_id, user_id, owner_headers)
+    async with AsyncSessionLocal() as db:
+        assert user_id not in await membership.get_chat_member_ids(db, chat_id)
+    monkeypatch.undo()
+
+    async with AsyncSessionLocal() as db:
+        assert user_id in await membership.get_chat_member_ids(db, chat_id)
+        forget_local()
+        assert user_id in await membership.get_chat_member_ids(db, chat_id)
@@ -0,0 +1,57 @@
+# Кэш первой страницы истории в Redis (crud.get_messages) при сообщениях, записанных во время прогрева
+import pytest
+
+import crud
+from redis_client import get_cached_messages, invalidate_message_cache
+
+pytestmark = pytest.mark.anyio
+
+
+async def send(client, chat_id, headers, content):
+    response = await client.post("/messages/", json={"content": content, "chat_id": chat_id}, headers=headers)
+    assert response.status_code == 200, response.text
+    assert response.json()["content"] == content
+    return response.json()["id"]
+
+
+def interleave(monkeypatch, during_warmup):
+    # Выполняет during_warmup между чтением снимка из базы и записью его в кэш
+    query_messages = crud._query_messages
+
+    async def query_then_interleave(*args, **kwargs):
+        snapshot = await query_messages(*args, **kwargs)
+        await during_warmup()
+        return snapshot
+
+    monkeypatch.setattr(crud, "_query_messages", query_then_interleave)
+
+
+async def test_message_committed_during_warmup_is_cached(client, chat, monkeypatch):
+    chat_id, headers, _ = await chat()
+    first = await send(client, chat_id, headers, "first")
+    sent = []
+
+    async def send_second():
+        sent.append(await send(client, chat_id, headers, "second"))
+
+    interleave(monkeypatch, send_second)
+    await client.get(f"/messages/{chat_id}", headers=headers)
+    monkeypatch.undo()
+
+    assert [message["id"] for message in await get_cached_messages(chat_id)] == [first, *sent]
+    page = (await client.get(f"/messages/{chat_id}", headers=headers)).json()
+    assert [message["content"] for message in page["messages"]] == ["first", "second"]
+
+
+async def test_invalidation_during_warmup_discards_snapshot(client, chat, monkeypatch):
+    chat_id, headers, _ = await chat()
+    await send(client, chat_id, headers, "first")
+
+    async def invalidate():
+        await invalidate_message_cache(chat_id)
+
+    interleave(monkeypatch, invalidate)
+    await client.get(f"/messages/{chat_id}", headers=headers)
+    monkeypatch.undo()
+
+    assert await get_cached_messages(chat_id) is None
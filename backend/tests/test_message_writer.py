@@ -0,0 +1,23 @@
+# Отправитель ждет коммита своей пачки (message_writer), не удерживая соединение из пула
+import pytest
+
+from database import async_engine
+from message_writer import message_writer
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_send_message_releases_connection_before_group_commit(client, chat, monkeypatch):
+    chat_id, headers, _ = await chat()
+    checked_out = []
+    submit = message_writer.submit
+
+    async def recording_submit(*args):
+        checked_out.append(async_engine.pool.checkedout())
+        return await submit(*args)
+
+    monkeypatch.setattr(message_writer, "submit", recording_submit)
+    response = await client.post("/messages/", json={"content": "hello", "chat_id": chat_id}, headers=headers)
+    assert response.status_code == 200, response.text
+
+    assert checked_out == [0]
@@ -0,0 +1,45 @@
+# Пока bcrypt считает хэш, запрос не держит соединение из пула базы
+import asyncio
+
+import pytest
+
+import passwords
+from conftest import TEST_PASSWORD
+from database import async_engine
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def checked_out_during_bcrypt(monkeypatch):
+    checked_out = []
+
+    def recording(func):
+        def wrapper(*args):
+            checked_out.append(async_engine.pool.checkedout())
+            return func(*args)
+        return wrapper
+
+    monkeypatch.setattr(passwords, "_hash_password", recording(passwords._hash_password))
+    monkeypatch.setattr(passwords, "_verify_password", recording(passwords._verify_password))
+    return checked_out
+
+
+async def test_register_and_login_release_connection(client, checked_out_during_bcrypt):
+    username = f"bcrypt_{id(checked_out_during_bcrypt)}"
+    response = await client.post("/register/", json={"username": username, "password": TEST_PASSWORD})
+    assert response.status_code == 200, response.text
+    response = await client.post("/token", data={"username": username, "password": TEST_PASSWORD})
+    assert response.status_code == 200, response.text
+
+    assert checked_out_during_bcrypt == [0, 0]
+
+
+async def test_concurrent_register_same_username(client):
+    # Оба запроса проходят предварительную проверку имени; повтор отсекает уникальный индекс при вставке
+    username = f"twin_{id(client)}"
+    responses = await asyncio.gather(*[
+        client.post("/register/", json={"username": username, "password": TEST_PASSWORD}) for _ in range(2)
+    ])
+    assert sorted(response.status_code for response in responses) == [200, 400]
+    assert "User already exists" in [response.json().get("detail") for response in responses]
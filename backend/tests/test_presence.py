@@ -0,0 +1,97 @@
+# Присутствие: пауза перед offline при переподключении и рассылка изменений пачками
+import asyncio
+import json
+
+import pytest
+
+import websocket
+from redis_client import get_online_users
+
+pytestmark = pytest.mark.anyio
+
+GRACE_PERIOD = 0.2
+FLUSH_INTERVAL = 0.05
+
+
+class RecordingSocket:
+    # Сокет без сети: ConnectionManager пишет в него кадры, тест их потом разбирает
+    def __init__(self):
+        self.scope = {"subprotocols": []}
+        self.frames = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        self.frames.append(json.loads(data))
+
+    async def send_bytes(self, data: bytes):
+        pass
+
+    async def close(self, code: int = 1000, reason: str = None):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def short_intervals(monkeypatch):
+    monkeypatch.setattr(websocket, "PRESENCE_GRACE_PERIOD", GRACE_PERIOD)
+    monkeypatch.setattr(websocket, "PRESENCE_FLUSH_INTERVAL", FLUSH_INTERVAL)
+
+
+def presence_changes(socket, user_id):
+    return [change["online"] for frame in socket.frames if frame["type"] == "presence"
+            for change in frame["users"] if change["user_id"] == user_id]
+
+
+async def online_ids():
+    return {user["id"] for user in await get_online_users()}
+
+
+async def test_reconnect_within_grace_period_keeps_user_online(client, register):
+    observer_id, observer_headers = await register()
+    user_id, _ = await register()
+    chat_ids = []
+    for name in ("first", "second"):
+        response = await client.post("/chats/", json={"name": name, "is_group": True, "members": [user_id]},
+                                     headers=observer_headers)
+        chat_ids.append(response.json()["id"])
+    manager = websocket.manager
+    observer = RecordingSocket()
+    observer_connection = await manager.connect(observer, observer_id, chat_ids[0], "observer")
+
+    # Переключение между чатами: сокет закрывается и сразу открывается новый
+    connection = await manager.connect(RecordingSocket(), user_id, chat_ids[0], "user")
+    for chat_id in chat_ids * 2:
+        manager.disconnect(connection)
+        connection = await manager.connect(RecordingSocket(), user_id, chat_id, "user")
+    await asyncio.sleep(GRACE_PERIOD * 2)
+    assert presence_changes(observer, user_id) == [True]
+    assert user_id in await online_ids()
+
+    manager.disconnect(connection)
+    await asyncio.sleep(GRACE_PERIOD / 2)
+    assert user_id in await online_ids()
+    await asyncio.sleep(GRACE_PERIOD * 2)
+    assert presence_changes(observer, user_id) == [True, False]
+    assert user_id not in await online_ids()
+    manager.disconnect(observer_connection)
+
+
+async def test_presence_changes_are_coalesced(chat, monkeypatch):
+    # Интервал с запасом, чтобы все подключения успели попасть в одну пачку
+    flush_interval = 0.5
+    monkeypatch.setattr(websocket, "PRESENCE_FLUSH_INTERVAL", flush_interval)
+    chat_id, _, ((observer_id, _), *users) = await chat(members=3)
+    manager = websocket.manager
+    observer = RecordingSocket()
+    observer_connection = await manager.connect(observer, observer_id, chat_id, "observer")
+    await asyncio.sleep(flush_interval * 2)
+    observer.frames.clear()
+
+    connections = [await manager.connect(RecordingSocket(), user_id, chat_id, f"user{user_id}") for user_id, _ in users]
+    await asyncio.sleep(flush_interval * 2)
+    presence_frames = [frame for frame in observer.frames if frame["type"] == "presence"]
+    assert len(presence_frames) == 1
+    assert {change["user_id"] for change in presence_frames[0]["users"]} == {user_id for user_id, _ in users}
+    for connection in connections + [observer_connection]:
+        manager.disconnect(connection)
@@ -0,0 +1,82 @@
+# Бюджет SQL-запросов горячих эндпоинтов. Тест падает, если эндпоинт начал ходить в базу чаще
+# (например, вернулся N+1): при осознанном изменении бюджет правится здесь вместе с кодом.
+# Считаются все запросы к базе за время запроса, включая запись сообщения в message_writer
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from database import async_engine
+
+pytestmark = pytest.mark.anyio
+
+CHAT_MEMBERS = 3
+MESSAGES = 70
+
+
+@contextmanager
+def statements():
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        yield executed
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+
+
+async def assert_budget(client, budget: int, method: str, url: str, **kwargs):
+    with statements() as executed:
+        response = await client.request(method, url, **kwargs)
+    assert response.status_code == 200, response.text
+    assert len(executed) == budget, "\n".join(executed)
+    return response
+
+
+@pytest.fixture
+async def history(chat, client):
+    # Чат с несколькими участниками и историей длиннее одной страницы; кэши прогреты первыми запросами
+    history = await chat(members=CHAT_MEMBERS - 1, messages=MESSAGES)
+    for _, user_headers in history.users:
+        await client.get("/chats/", headers=user_headers)
+        await client.get(f"/messages/{history.id}", headers=user_headers)
+    return history
+
+
+async def test_chat_list(client, history):
+    # Чаты с последним сообщением и участники - двумя запросами при любом числе чатов и участников
+    chat_id, headers, _ = history
+    members = [member["id"] for member in (await client.get("/chats/", headers=headers)).json()[0]["members"]]
+    await client.post("/chats/", json={"name": "second", "is_group": True, "members": members}, headers=headers)
+    await client.post("/messages/", json={"content": "hello", "chat_id": chat_id}, headers=headers)
+    await client.get("/chats/", headers=headers)
+    response = await assert_budget(client, 2, "GET", "/chats/", headers=headers)
+    assert [len(chat["members"]) for chat in response.json()] == [CHAT_MEMBERS, CHAT_MEMBERS]
+
+
+async def test_first_history_page_is_served_from_cache(client, history):
+    chat_id, headers, _ = history
+    response = await assert_budget(client, 0, "GET", f"/messages/{chat_id}", headers=headers)
+    assert len(response.json()["messages"]) == 60
+
+
+async def test_older_history_page(client, history):
+    chat_id, headers, _ = history
+    first_page = (await client.get(f"/messages/{chat_id}", headers=headers)).json()
+    response = await assert_budget(client, 1, "GET", f"/messages/{chat_id}",
+                                   params={"before_id": first_page["next_cursor"]}, headers=headers)
+    assert len(response.json()["messages"]) == MESSAGES - 60
+
+
+async def test_send_message(client, history):
+    # Чтение имени чата и участников, вставка сообщения и его слов в поисковый индекс
+    chat_id, headers, _ = history
+    await assert_budget(client, 3, "POST", "/messages/", json={"content": "budget check", "chat_id": chat_id},
+                        headers=headers)
+
+
+async def test_online_users(client, history):
+    await assert_budget(client, 0, "GET", "/online-users/")
@@ -0,0 +1,52 @@
+# Подключение к /ws/{chat_id} с настоящей проверкой токена (без подмены зависимостей)
+import pytest
+
+from conftest import WebSocketClient
+from protocol import AUTH_SUBPROTOCOL_PREFIX, JSON_SUBPROTOCOL
+
+pytestmark = pytest.mark.anyio
+
+
+def token(headers: dict) -> str:
+    return headers["Authorization"].removeprefix("Bearer ")
+
+
+async def test_token_in_subprotocol(app, chat):
+    chat_id, headers, _ = await chat()
+    async with WebSocketClient(app, f"/ws/{chat_id}",
+                               subprotocols=[JSON_SUBPROTOCOL, AUTH_SUBPROTOCOL_PREFIX + token(headers)]) as ws:
+        assert ws.accepted
+        # Токен не возвращается клиенту в выбранном подпротоколе
+        assert ws.subprotocol == JSON_SUBPROTOCOL
+        await ws.send_json({"type": "message", "content": "hello", "ref": 1})
+        frames = [await ws.receive_json() for _ in range(2)]
+        ack = next(frame for frame in frames if frame["type"] == "ack")
+        assert ack["ref"] == 1
+
+
+async def test_token_in_query(app, chat):
+    chat_id, headers, _ = await chat()
+    async with WebSocketClient(app, f"/ws/{chat_id}", params={"token": token(headers)},
+                               subprotocols=[JSON_SUBPROTOCOL]) as ws:
+        assert ws.accepted
+        await ws.send_json({"type": "ping"})
+        assert (await ws.receive_json())["type"] == "pong"
+
+
+@pytest.mark.parametrize("subprotocols", [
+    [JSON_SUBPROTOCOL],
+    [JSON_SUBPROTOCOL, AUTH_SUBPROTOCOL_PREFIX + "not-a-jwt"],
+])
+async def test_rejects_missing_or_invalid_token(app, chat, subprotocols):
+    chat_id, _, _ = await chat()
+    async with WebSocketClient(app, f"/ws/{chat_id}", subprotocols=subprotocols) as ws:
+        assert not ws.accepted
+        assert ws.close_code == 1008
+
+
+async def test_rejects_non_member(app, chat, register):
+    chat_id, _, _ = await chat()
+    _, headers = await register()
+    async with WebSocketClient(app, f"/ws/{chat_id}", subprotocols=[AUTH_SUBPROTOCOL_PREFIX + token(headers)]) as ws:
+        assert not ws.accepted
+        assert ws.close_code == 1008
@@ -1,45 +1,376 @@
 import asyncio
+import json
+import logging
+import os
 import websockets
-from fastapi import WebSocket, WebSocketDisconnect
-from typing import List
-from redis_client import cache_message, publish_notification
-from encryption import encrypt_message, decrypt_message
+from fastapi import WebSocket, WebSocketDisconnect, status
+from pydantic import ValidationError
+from typing import Dict, List, Optional, Set
+from database import AsyncSessionLocal
+from crud import create_message
+from membership import is_chat_member, get_chat_member_ids, handle_membership_event
+from encryption import message_crypto
+from metrics import WS_CONNECTIONS, WS_FANOUT, WS_SEND_QUEUE_DEPTH, WS_DROPPED_FRAMES
+from models import User
+from schemas import MessageCreate
+from protocol import (
+    Frame, ProtocolError, choose_subprotocol, decode_client_frame, MSGPACK_SUBPROTOCOL, FRAME_MESSAGE,
+    FRAME_NOTIFICATION, FRAME_PRESENCE, FRAME_ACK, FRAME_RESYNC, FRAME_PING, FRAME_PONG, FRAME_ERROR
+)
+from redis_client import (
+    redis_client, publish_notification, publish_chat_event, get_chat_events_since, split_chat_event,
+    add_online_user, remove_online_user, mark_users_online, expire_offline_users, CHAT_CHANNEL_PREFIX,
+    NOTIFICATION_CHANNEL_PREFIX, PRESENCE_CHANNEL, AUTH_INVALIDATE_CHANNEL, MEMBERSHIP_CHANNEL
+)
+from auth import forget_user
+from rate_limit import RateLimitExceeded, limit_message, limit_ws_frame
+
+logger = logging.getLogger(__name__)
+
+# Максимальное число неотправленных сообщений на одно соединение
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# Пауза перед переподключением подписчика к Redis
+SUBSCRIBER_RETRY_DELAY = float(os.getenv("WS_SUBSCRIBER_RETRY_DELAY", "1"))
+# Как часто узел подтверждает присутствие своих пользователей (должно быть заметно меньше PRESENCE_TTL)
+PRESENCE_HEARTBEAT_INTERVAL = float(os.getenv("PRESENCE_HEARTBEAT_INTERVAL", "15"))
+# Что делать с медленным клиентом при переполнении очереди: "disconnect" или "drop"
+SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "disconnect")
+# Сколько пользователь остается онлайн после закрытия последнего сокета: клиент переподключается при каждой
+# смене чата, и без паузы каждое переключение рассылало бы всем offline, а следом online
+PRESENCE_GRACE_PERIOD = float(os.getenv("PRESENCE_GRACE_PERIOD", "5"))
+# Изменения присутствия копятся и рассылаются одним кадром не чаще раза в этот интервал
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "1"))
+
+
+class ClientConnection:
+    def __init__(self, websocket: WebSocket, user_id: int, chat_id: int, subprotocol: Optional[str] = None,
+                 since_seq: Optional[int] = None):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.binary = subprotocol == MSGPACK_SUBPROTOCOL
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.sender_task: asyncio.Task | None = None
+        self.dropped = 0
+        # Последний отправленный seq чата; пока идет догрузка пропущенного, живые события копятся в resume_buffer
+        self.last_seq = since_seq or 0
+        self.resume_buffer: Optional[List[Frame]] = [] if since_seq is not None else None
+
+    def enqueue(self, frame: Frame) -> bool:
+        if frame.seq is not None:
+            if self.resume_buffer is not None:
+                self.resume_buffer.append(frame)
+                return True
+            if frame.seq <= self.last_seq:
+                return True
+            self.last_seq = frame.seq
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            WS_DROPPED_FRAMES.inc()
+            return False
+        WS_SEND_QUEUE_DEPTH.observe(self.queue.qsize())
+        return True
+
+    async def run_sender(self):
+        # Каждый сокет отправляет из своей очереди, поэтому медленный клиент не задерживает остальных
+        try:
+            while True:
+                frame = await self.queue.get()
+                if self.binary:
+                    await self.websocket.send_bytes(frame.binary())
+                else:
+                    await self.websocket.send_text(frame.text())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"Stopped sending to user {self.user_id} in chat {self.chat_id}: {e}")
+
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: dict[int, List[WebSocket]] = {}
+        self.active_connections: Dict[int, Set[ClientConnection]] = {}
+        self.chat_connections: Dict[int, Set[ClientConnection]] = {}
+        # Пользователи, которых этот узел считает онлайн (включая тех, у кого идет PRESENCE_GRACE_PERIOD)
+        self.usernames: Dict[int, str] = {}
+        self._background_tasks: Set[asyncio.Task] = set()
+        self._offline_timers: Dict[int, asyncio.Task] = {}
+        # user_id -> последнее изменение присутствия, еще не разосланное сокетам
+        self._presence_changes: Dict[int, dict] = {}
+        self._presence_flush: Optional[asyncio.Task] = None
+
+    async def connect(self, websocket: WebSocket, user_id: int, chat_id: int, username: str,
+                      since_seq: Optional[int] = None):
+        if not await _check_membership(chat_id, user_id):
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return None
+
+        subprotocol = choose_subprotocol(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=subprotocol)
+        connection = ClientConnection(websocket, user_id, chat_id, subprotocol, since_seq)
+        connection.sender_task = asyncio.create_task(connection.run_sender())
+        self.active_connections.setdefault(user_id, set()).add(connection)
+        self.chat_connections.setdefault(chat_id, set()).add(connection)
+        WS_CONNECTIONS.inc()
+        # Переподключение в пределах PRESENCE_GRACE_PERIOD: пользователь и не уходил в offline
+        timer = self._offline_timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        if user_id not in self.usernames:
+            self.usernames[user_id] = username
+            await _update_presence(add_online_user(user_id, username))
+        if since_seq is not None:
+            await self._resume(connection, since_seq)
+        return connection
+
+    async def _resume(self, connection: ClientConnection, since_seq: int):
+        # Догружаем пропущенные события из буфера чата в Redis. Живые события, пришедшие за это время,
+        # лежат в resume_buffer, а повторы отсекаются по seq
+        try:
+            current_seq, events = await get_chat_events_since(connection.chat_id, since_seq)
+        except Exception as e:
+            logger.warning(f"Failed to load missed events for chat {connection.chat_id}: {e}")
+            current_seq, events = None, []
+        buffered, connection.resume_buffer = connection.resume_buffer, None
+        if _replay_covers_gap(since_seq, current_seq, events):
+            frames = await _message_frames(connection.chat_id, events)
+        else:
+            # Буфер уже не покрывает пропуск: клиент перечитывает историю через REST и продолжает с нового seq
+            connection.last_seq = current_seq or 0
+            frames = [Frame(FRAME_RESYNC, {"chat_id": connection.chat_id, "seq": connection.last_seq})]
+        for frame in frames + buffered:
+            connection.enqueue(frame)
 
-    async def connect(self, websocket: WebSocket, user_id: int):
-        await websocket.accept()
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = []
-        self.active_connections[user_id].append(websocket)
+    def disconnect(self, connection: ClientConnection):
+        # Может вызываться повторно (медленный клиент уже отключен, затем finally в handle_websocket)
+        if connection not in self.active_connections.get(connection.user_id, ()):
+            return
+        WS_CONNECTIONS.dec()
+        _discard(self.active_connections, connection.user_id, connection)
+        _discard(self.chat_connections, connection.chat_id, connection)
+        if connection.sender_task is not None:
+            connection.sender_task.cancel()
+        user_id = connection.user_id
+        if user_id in self.active_connections or user_id not in self.usernames or user_id in self._offline_timers:
+            return
+        self._offline_timers[user_id] = self._spawn(self._go_offline(user_id, PRESENCE_GRACE_PERIOD))
 
-    def disconnect(self, websocket: WebSocket, user_id: int):
-        if user_id in self.active_connections:
-            self.active_connections[user_id].remove(websocket)
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
+    async def _go_offline(self, user_id: int, delay: float = 0):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._offline_timers.pop(user_id, None)
+        if user_id not in self.active_connections and self.usernames.pop(user_id, None):
+            await _update_presence(remove_online_user(user_id))
 
-    async def broadcast_to_chat(self, message: str, chat_id: str):
-        for user_id, connections in self.active_connections.items():
-            for connection in connections:
-                await connection.send_text(message)
+    async def close_all(self, code: int = status.WS_1012_SERVICE_RESTART, reason: str = "Server restart, reconnect"):
+        connections = [c for connections in self.active_connections.values() for c in connections]
+        for connection in connections:
+            self.disconnect(connection)
+        await asyncio.gather(*(_close_quietly(c.websocket, code, reason) for c in connections))
+        # При остановке не ждем окончания паузы: присутствие снимается сразу
+        for user_id, timer in list(self._offline_timers.items()):
+            timer.cancel()
+            self._spawn(self._go_offline(user_id))
+        if self._presence_flush is not None:
+            self._presence_flush.cancel()
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    def queue_presence(self, event: dict):
+        # Изменения за интервал уходят одним кадром; у пользователя остается только последнее состояние
+        self._presence_changes[event["user_id"]] = event
+        if self._presence_flush is None:
+            self._presence_flush = self._spawn(self._flush_presence())
+
+    async def _flush_presence(self):
+        await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+        changes, self._presence_changes = self._presence_changes, {}
+        self._presence_flush = None
+        await self.broadcast_to_all(Frame(FRAME_PRESENCE, {"users": list(changes.values())}))
+
+    async def broadcast_to_all(self, frame: Frame):
+        self._deliver([c for connections in self.active_connections.values() for c in connections], frame, "all")
+
+    async def broadcast_to_chat(self, frame: Frame, chat_id: int):
+        self._deliver(list(self.chat_connections.get(chat_id, ())), frame, "chat")
 
     async def notify_user(self, user_id: int, message: str):
-        if user_id in self.active_connections:
-            for connection in self.active_connections[user_id]:
-                await connection.send_text(f"NOTIFICATION: {message}")
+        frame = Frame(FRAME_NOTIFICATION, {"text": message})
+        self._deliver(list(self.active_connections.get(user_id, ())), frame, "user")
+
+    def _deliver(self, connections: List[ClientConnection], frame: Frame, kind: str):
+        WS_FANOUT.labels(kind).observe(len(connections))
+        for connection in connections:
+            if not connection.enqueue(frame):
+                self._handle_slow_consumer(connection)
+
+    def _handle_slow_consumer(self, connection: ClientConnection):
+        if SLOW_CONSUMER_POLICY == "drop":
+            logger.warning(f"Send queue full for user {connection.user_id}, dropped {connection.dropped} messages")
+            return
+        logger.warning(f"Disconnecting slow consumer: user {connection.user_id} in chat {connection.chat_id}")
+        self.disconnect(connection)
+        self._spawn(_close_quietly(connection.websocket, status.WS_1013_TRY_AGAIN_LATER))
+
+
+def _discard(index: Dict[int, Set[ClientConnection]], key: int, connection: ClientConnection):
+    connections = index.get(key)
+    if connections is None:
+        return
+    connections.discard(connection)
+    if not connections:
+        del index[key]
+
+
+async def _check_membership(chat_id: int, user_id: int) -> bool:
+    async with AsyncSessionLocal() as db:
+        return await is_chat_member(db, chat_id, user_id)
+
+
+async def _update_presence(operation):
+    # Присутствие не должно ломать обмен сообщениями, если Redis недоступен
+    try:
+        await operation
+    except Exception as e:
+        logger.warning(f"Failed to update presence: {e}")
+
+
+def _replay_covers_gap(since_seq: int, current_seq: Optional[int], events: List[tuple]) -> bool:
+    if current_seq is None or current_seq < since_seq:
+        return False
+    if current_seq == since_seq:
+        return True
+    # Слишком длинную догрузку не кладем в очередь сокета: она вытеснила бы живые сообщения
+    return bool(events) and events[0][0] == since_seq + 1 and len(events) <= SEND_QUEUE_SIZE // 2
+
+
+async def _message_frames(chat_id: int, events: List[tuple]) -> List[Frame]:
+    # События чата несут шифротекст; расшифровываем один раз на узел, а не на каждый сокет
+    messages = await message_crypto.decrypt_messages([json.loads(payload) for _, payload in events])
+    return [
+        Frame(FRAME_MESSAGE, {"chat_id": chat_id, "message": message}, seq=seq)
+        for (seq, _), message in zip(events, messages)
+    ]
+
+
+async def _close_quietly(websocket: WebSocket, code: int, reason: str = None):
+    try:
+        await websocket.close(code=code, reason=reason)
+    except Exception:
+        pass
+
 
 manager = ConnectionManager()
 
-async def handle_websocket(websocket: WebSocket, chat_id: str, user_id: int):
-    await manager.connect(websocket, user_id)
+async def run_subscriber():
+    # Один подписчик на процесс: получает сообщения со всех узлов и раздает их локальным сокетам
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.psubscribe(f"{CHAT_CHANNEL_PREFIX}*", f"{NOTIFICATION_CHANNEL_PREFIX}*", PRESENCE_CHANNEL,
+                                    AUTH_INVALIDATE_CHANNEL, MEMBERSHIP_CHANNEL)
+            logger.info("Redis subscriber started")
+            async for event in pubsub.listen():
+                if event["type"] == "pmessage":
+                    await _route_event(event["channel"].decode(), event["data"].decode())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Redis subscriber failed: {e}, reconnecting in {SUBSCRIBER_RETRY_DELAY}s")
+            await asyncio.sleep(SUBSCRIBER_RETRY_DELAY)
+        finally:
+            await pubsub.aclose()
+
+async def _route_event(channel: str, data: str):
+    try:
+        if channel == PRESENCE_CHANNEL:
+            event = json.loads(data)
+            event.pop("type", None)
+            manager.queue_presence(event)
+        elif channel == AUTH_INVALIDATE_CHANNEL:
+            forget_user(data)
+        elif channel == MEMBERSHIP_CHANNEL:
+            handle_membership_event(data)
+        elif channel.startswith(CHAT_CHANNEL_PREFIX):
+            chat_id = int(channel[len(CHAT_CHANNEL_PREFIX):])
+            if chat_id in manager.chat_connections:
+                frames = await _message_frames(chat_id, [split_chat_event(data)])
+                await manager.broadcast_to_chat(frames[0], chat_id)
+        elif channel.startswith(NOTIFICATION_CHANNEL_PREFIX):
+            await manager.notify_user(int(channel[len(NOTIFICATION_CHANNEL_PREFIX):]), data)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # Ошибка в одном событии не должна обрывать подписку: на время переподключения терялись бы события всех чатов
+        logger.warning(f"Ignoring malformed event on channel {channel}: {e!r}")
+
+async def run_presence_heartbeat():
+    # Продлевает присутствие пользователей этого узла и снимает тех, чьи узлы перестали отвечать.
+    # Живость самих сокетов проверяет uvicorn через WebSocket ping (--ws-ping-interval)
+    while True:
+        await asyncio.sleep(PRESENCE_HEARTBEAT_INTERVAL)
+        try:
+            if manager.usernames:
+                await mark_users_online(dict(manager.usernames))
+            await expire_offline_users()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Presence heartbeat failed: {e}")
+
+async def handle_websocket(websocket: WebSocket, chat_id: int, user: User, since_seq: Optional[int] = None):
+    connection = await manager.connect(websocket, user.id, chat_id, user.username, since_seq)
+    if connection is None:
+        return
     try:
         while True:
-            data = await websocket.receive_text()
-            encrypted_data = encrypt_message(data)
-            cache_message(chat_id, {"content": encrypted_data, "user_id": user_id})
-            await manager.broadcast_to_chat(encrypted_data, chat_id)
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(received.get("code", status.WS_1000_NORMAL_CLOSURE))
+            try:
+                await limit_ws_frame(user.id)
+            except RateLimitExceeded:
+                logger.warning(f"Closing WebSocket of user {user.id}: frame rate limit exceeded")
+                await _close_quietly(websocket, status.WS_1008_POLICY_VIOLATION, "Rate limit exceeded")
+                break
+            data = received.get("bytes")
+            if data is None:
+                data = received.get("text", "")
+            try:
+                frame = decode_client_frame(data)
+                reply = await _handle_client_frame(frame, chat_id, user)
+            except (ProtocolError, ValidationError) as e:
+                reply = Frame(FRAME_ERROR, {"detail": str(e)})
+            except RateLimitExceeded as e:
+                # Сообщение не принято, но соединение остается: клиент может повторить через retry_after
+                reply = Frame(FRAME_ERROR, {"detail": str(e), "ref": frame.get("ref"),
+                                            "retry_after": e.retry_after_seconds})
+            if reply is not None and not connection.enqueue(reply):
+                manager._handle_slow_consumer(connection)
+                break
     except WebSocketDisconnect:
-        manager.disconnect(websocket, user_id)
\ No newline at end of file
+        pass
+    finally:
+        manager.disconnect(connection)
+
+async def _handle_client_frame(frame: dict, chat_id: int, user: User) -> Optional[Frame]:
+    if frame["type"] == FRAME_PING:
+        return Frame(FRAME_PONG)
+    if frame["type"] != FRAME_MESSAGE:
+        raise ProtocolError(f"Unsupported frame type {frame['type']}")
+    # Сообщение сохраняется так же, как через REST: с id и timestamp из базы и записью в кэш
+    message_create = MessageCreate(content=frame.get("content"), chat_id=chat_id)
+    await limit_message(user.id, chat_id)
+    async with AsyncSessionLocal() as db:
+        member_ids = await get_chat_member_ids(db, chat_id)
+    message = await create_message(message_create, user, member_ids)
+    # Рассылка идет через Redis, чтобы сообщение получили сокеты на всех узлах
+    seq = await publish_chat_event(chat_id, json.dumps(message))
+    return Frame(FRAME_ACK, {"ref": frame.get("ref"), "id": message["id"], "seq": seq})
@@ -1,6 +1,15 @@
 let token = null;
 let currentChatId = null;
 let ws = null;
+// Последний полученный seq текущего чата: с него WebSocket продолжает после переподключения
+let lastSeq = null;
+// Переподключение с экспоненциальной паузой: 1 с, 2 с, 4 с ... не больше 30 с; сбрасывается после открытия
+const RECONNECT_MIN_DELAY = 1000;
+const RECONNECT_MAX_DELAY = 30000;
+let reconnectDelay = RECONNECT_MIN_DELAY;
+let reconnectTimer = null;
+// Онлайн-пользователи: полный список загружается один раз, дальше приходят изменения по WebSocket
+const onlineUsers = new Map();
 
 // API запросы идут через nginx на /api
 const API_BASE_URL = '/api';
@@ -159,7 +168,10 @@ function loadChats() {
         ul.innerHTML = '';
         chats.forEach(chat => {
             const li = document.createElement('li');
-            li.textContent = chat.name;
+            li.textContent = chat.unread_count > 0 ? `${chat.name} (${chat.unread_count})` : chat.name;
+            if (chat.last_message) {
+                li.title = `${chat.last_message.user.username}: ${chat.last_message.content}`;
+            }
             li.onclick = () => {
                 openChat(chat.id, chat.name);
                 if (window.innerWidth < 768) {
@@ -191,13 +203,21 @@ function loadMessages(chatId) {
         headers: {'Authorization': `Bearer ${token}`}
     })
     .then(response => response.json())
-    .then(messages => {
+    .then(page => {
         const container = document.getElementById('messages');
         container.innerHTML = '';
-        messages.forEach(msg => {
+        page.messages.forEach(msg => {
             addMessageToDOM(msg);
         });
         container.scrollTop = container.scrollHeight;
+        markChatRead(chatId);
+    });
+}
+
+function markChatRead(chatId) {
+    fetch(`${API_BASE_URL}/chats/${chatId}/read`, {
+        method: 'POST',
+        headers: {'Authorization': `Bearer ${token}`}
     });
 }
 
@@ -224,22 +244,71 @@ function sendMessage() {
         },
         body: JSON.stringify({content, chat_id: currentChatId})
     })
-    .then(() => {
+    .then(response => {
+        if (response.status === 429) {
+            // Текст остается в поле, чтобы отправить его позже
+            alert('Слишком много сообщений, подождите немного');
+            return;
+        }
         input.value = '';
     });
 }
 
-function connectWebSocket(chatId) {
-    if (ws) ws.close();
+function connectWebSocket(chatId, sinceSeq = null) {
+    if (ws) {
+        ws.onclose = null;
+        ws.close();
+    }
+    clearTimeout(reconnectTimer);
+    if (sinceSeq === null) lastSeq = null;
     // WebSocket через nginx на /ws
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-    const wsUrl = `${protocol}//${window.location.host}/ws/${chatId}`;
+    let wsUrl = `${protocol}//${window.location.host}/ws/${chatId}`;
+    if (sinceSeq !== null) wsUrl += `?since_seq=${sinceSeq}`;
 
-    ws = new WebSocket(wsUrl);
+    // Заголовок Authorization браузер к сокету не добавляет: токен передается подпротоколом
+    ws = new WebSocket(wsUrl, ['chat.v1.json', `access_token.${token}`]);
+
+    ws.onopen = function() {
+        reconnectDelay = RECONNECT_MIN_DELAY;
+    };
 
     ws.onmessage = function(event) {
-        const data = JSON.parse(event.data);
-        addMessageToDOM(data);
+        const frame = JSON.parse(event.data);
+        switch (frame.type) {
+            case 'message':
+                if (lastSeq !== null && frame.seq <= lastSeq) return;
+                if (lastSeq !== null && frame.seq > lastSeq + 1) {
+                    // Пропуск в нумерации: перечитываем историю
+                    loadMessages(chatId);
+                } else {
+                    addMessageToDOM(frame.message);
+                }
+                lastSeq = frame.seq;
+                break;
+            case 'resync':
+                lastSeq = frame.seq;
+                loadMessages(chatId);
+                break;
+            case 'presence':
+                applyPresence(frame);
+                break;
+            case 'notification':
+                console.log('Уведомление:', frame.text);
+                break;
+        }
+    };
+
+    ws.onclose = function() {
+        if (currentChatId !== chatId) return;
+        // since_seq отправляется, только если клиент уже видел seq: иначе сервер повторил бы весь буфер
+        // поверх истории, загруженной через REST. Без seq пропущенное за время разрыва дочитывается через REST
+        reconnectTimer = setTimeout(() => {
+            if (currentChatId !== chatId) return;
+            if (lastSeq === null) loadMessages(chatId);
+            connectWebSocket(chatId, lastSeq);
+        }, reconnectDelay);
+        reconnectDelay = Math.min(reconnectDelay * 2, RECONNECT_MAX_DELAY);
     };
 }
 
@@ -267,14 +336,32 @@ function loadOnlineUsers() {
         return response.json();
     })
     .then(users => {
-        const container = document.getElementById('online-users');
-        container.innerHTML = `<p>Онлайн: ${users.length} пользователей</p>`;
+        onlineUsers.clear();
+        users.forEach(user => onlineUsers.set(user.id, user.username));
+        renderOnlineUsers();
     })
     .catch(err => {
         console.error('Ошибка загрузки онлайн пользователей:', err);
     });
 }
 
+function applyPresence(frame) {
+    // Сервер присылает изменения присутствия пачкой за интервал
+    frame.users.forEach(event => {
+        if (event.online) {
+            onlineUsers.set(event.user_id, event.username);
+        } else {
+            onlineUsers.delete(event.user_id);
+        }
+    });
+    renderOnlineUsers();
+}
+
+function renderOnlineUsers() {
+    const container = document.getElementById('online-users');
+    container.innerHTML = `<p>Онлайн: ${onlineUsers.size} пользователей</p>`;
+}
+
 function toggleChatList() {
     const container = document.getElementById('chat-list-container');
     container.classList.toggle('open');